@@ -0,0 +1,187 @@
+#!/usr/bin/python3
+# Measures how fast cue_playlist.analyse() gets through a corpus of synthetic tracks, and checks
+# the cue points it finds against those expected from the way each track was made.
+# The corpus is made once by FFmpeg's lavfi sources, and kept for later runs: tones and noise
+# with silent lead-ins, linear fades, long quiet tails, tracks under 30s, and a multi-hour track.
+# Each analysis path runs in a process of its own, so that its peak memory is its own.
+# Exits with status 1 if any cue point is wrong.
+
+import argparse, concurrent.futures, contextlib, glob, os, resource, subprocess, sys, time
+import numpy as np
+import r128
+import cue_playlist
+
+FFMPEG = cue_playlist.FFMPEG
+
+LEVEL = 8.0
+CUE = 40.0
+# Peak amplitude at full gain: a 997Hz stereo tone at this level measures about -10.5 LUFS
+AMPLITUDE = 0.3
+PATHS = ["ffmpeg", "numpy", "single-pass", "windowed", "tags"]
+
+def corpus(hours):
+    # Each track is a name, a source ("tone" or "noise"), and a list of segments: each segment lasts
+    # a number of seconds while the gain goes linearly from its first value to its second.
+    tracks = [
+        ("tone-leadin-fade", "tone", [(2.5, 0, 0), (60, 1, 1), (8, 1, 0), (1, 0, 0)]),
+        ("noise-leadin-fade", "noise", [(1, 0, 0), (90, 1, 1), (12, 1, 0), (0.5, 0, 0)]),
+        ("tone-abrupt", "tone", [(0.2, 0, 0), (45, 1, 1)]),
+        ("tone-long-tail", "tone", [(0.5, 0, 0), (100, 1, 1), (40, 0.2, 0.2), (3, 0.2, 0)]),
+        ("noise-long-tail", "noise", [(1.5, 0, 0), (80, 1, 1), (2, 1, 0.2), (30, 0.2, 0.2), (4, 0.2, 0)]),
+        ("tone-short", "tone", [(0.3, 0, 0), (12, 1, 1), (3, 1, 0)]),
+        ("noise-short", "noise", [(0.7, 0, 0), (20, 1, 1)]),
+        ("tone-fade-in", "tone", [(1, 0, 0), (5, 0, 1), (50, 1, 1), (10, 1, 0)]),
+    ]
+    if hours > 0:
+        tracks.append(("tone-hours", "tone", [(0.8, 0, 0), (hours * 3600, 1, 1), (20, 1, 0)]))
+    return(tracks)
+
+def gainExpression(segments):
+    # The gain envelope as an FFmpeg expression of t, one nested if() per segment
+    expression = "0"
+    start = sum(seconds for seconds, _, _ in segments)
+    for seconds, first, last in reversed(segments):
+        start -= seconds
+        gain = "%g" % first if first == last else "(%g+%g*(t-%g)/%g)" % (first, last - first, start, seconds)
+        expression = "if(lt(t\\,%g)\\,%s\\,%s)" % (start + seconds, gain, expression)
+    return(expression)
+
+def makeTrack(filename, source, segments):
+    signal = "sin(2*PI*997*t)" if source == "tone" else "(2*random(0)-1)"
+    duration = sum(seconds for seconds, _, _ in segments)
+    expression = "%g*%s*%s" % (AMPLITUDE, gainExpression(segments), signal)
+    subprocess.check_call([FFMPEG, "-hide_banner", "-v", "quiet", "-y", "-f", "lavfi", "-i", \
+            "aevalsrc=%s:c=stereo:s=%d:d=%g" % (expression, r128.SAMPLE_RATE, duration), \
+            "-c:a", "flac", filename + ".part.flac"])
+    os.replace(filename + ".part.flac", filename)
+
+def crossings(segments, gain):
+    # The first and last times the gain envelope is above 'gain', found by interpolating along
+    # the segment where it crosses, or None if it never is
+    first = last = None
+    start = 0.0
+    for seconds, a, b in segments:
+        if max(a, b) > gain:
+            rise = start if a > gain else start + seconds * (gain - a) / (b - a)
+            fall = start + seconds if b > gain else start + seconds * (gain - a) / (b - a)
+            first = rise if first is None else first
+            last = fall
+        start += seconds
+    return(first, last)
+
+def expected(segments):
+    # The cue points that should be found, worked out from the gain envelope alone, so that they
+    # don't depend on the meter or the cue search being tested.
+    # The integrated loudness, relative to full gain, is the mean power of the envelope where it
+    # passes the absolute gate (about -60dB here) and then the relative gate, 10dB below that.
+    # Each cue point is where the envelope crosses its threshold below that loudness. The meter
+    # reports the 400ms window ending 100ms after each frame's time, and the cue-in point is
+    # taken 400ms before that frame, so it falls 0.4s to 0.5s before the rise. A fall is seen
+    # 0.1s after it happens. The last frame starts 0.1s before the end.
+    steps = []
+    for seconds, first, last in segments:
+        count = int(round(seconds * 1000))
+        steps.append(first + (last - first) * (np.arange(count) + 0.5) / count)
+    power = np.concatenate(steps) ** 2
+    audible = power[power > 1e-6]
+    level = 10 * np.log10(audible[audible >= 0.1 * audible.mean()].mean())
+    duration = sum(seconds for seconds, _, _ in segments) - 0.1
+
+    onset, _ = crossings(segments, 10 ** ((level - CUE) / 20))
+    _, fall = crossings(segments, 10 ** ((level - LEVEL) / 20))
+    nextTime = min(fall + 0.1, duration)
+    longTail = duration - nextTime > r128.LONG_TAIL
+    if longTail:
+        _, fall = crossings(segments, 10 ** ((level - LEVEL - r128.LONG_TAIL) / 20))
+        nextTime = min(fall + 0.1, duration)
+    return({"cue_point": max(0.0, onset - 0.45), "start_next": max(duration - nextTime, 0.0), "longtail": str(longTail)})
+
+def runPath(path, filenames, mezzanine, jobs):
+    # Runs in a process of its own. Returns the results for each file, and what the run cost.
+    arguments = {"ffmpeg": {}, "numpy": {"engine": "numpy"}, "single-pass": {"mezzanine": mezzanine, "singlePass": True},
+                 "windowed": {"windowed": (30.0, 60.0)}, "tags": {"trustTags": True}}[path]
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as quiet, contextlib.redirect_stdout(quiet):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(lambda filename: cue_playlist.analyse(filename, LEVEL, CUE, **arguments), filenames))
+    wall = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return({"results": results, "wall": wall,
+            "child_cpu": (after.ru_utime - children.ru_utime) + (after.ru_stime - children.ru_stime),
+            "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "child_rss": after.ru_maxrss / 1024})
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cue_playlist.analyse() on a synthetic corpus, and check the cue points it finds.")
+    parser.add_argument("-d", "--corpus", help="Directory for the generated tracks, kept between runs. Default: %(default)s", default="benchmark-corpus")
+    parser.add_argument("--hours", help="Length of the multi-hour track, or 0 to leave it out. Default: %(default)s", default=2.0, type=float)
+    parser.add_argument("-p", "--path", help="Analysis path to run. Can be given multiple times. Default: all of them",
+                        action="append", choices=PATHS)
+    parser.add_argument("-j", "--jobs", help="Number of tracks to analyse at once. Default: %(default)s", default=1, type=int)
+    parser.add_argument("-t", "--tolerance", help="Largest error allowed in a cue point, in seconds. Default: %(default)s", default=0.25, type=float)
+    args = parser.parse_args()
+
+    paths = [path for path in PATHS if path in (args.path or PATHS)]
+    tracks = corpus(args.hours)
+    mezzanine = os.path.abspath(os.path.join(args.corpus, "mezzanine"))
+    os.makedirs(mezzanine, exist_ok=True)
+
+    sources = {}
+    truth = {}
+    for name, source, segments in tracks:
+        filename = os.path.join(args.corpus, name + ".flac")
+        if not os.path.exists(filename):
+            print("Generating %s" % filename)
+            makeTrack(filename, source, segments)
+        sources[name] = filename
+        truth[name] = expected(segments)
+    audioHours = sum(seconds for _, _, segments in tracks for seconds, _, _ in segments) / 3600
+
+    passed = True
+    print("%-12s %7s %9s %9s %14s %14s %9s %9s %7s" % ("path", "tracks", "wall s", "tracks/s", "wall s/audio h",
+                                                      "decode s/audio h", "RSS MB", "child MB", "errors"))
+    for path in paths:
+        if path == "single-pass":
+            # Start from an empty mezzanine directory, so that every track is encoded
+            for old in glob.glob(os.path.join(mezzanine, "*.mka")):
+                os.remove(old)
+        if path in ("windowed", "tags"):
+            # These are for files that were tagged when they were made into mezzanine files
+            names = {}
+            for filename in glob.glob(os.path.join(mezzanine, "*.mka")):
+                names[os.path.basename(filename).split(".")[0]] = filename
+            if not names:
+                print("%-12s no mezzanine files: run the single-pass path first" % path)
+                continue
+        else:
+            names = sources
+        order = sorted(names)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            run = pool.submit(runPath, path, [names[name] for name in order], mezzanine, args.jobs).result()
+
+        errors = []
+        for name, result in zip(order, run["results"]):
+            want = truth[name]
+            if result is None:
+                errors.append("%s: no result" % name)
+                continue
+            for key in ("cue_point", "start_next"):
+                if abs(result[key] - want[key]) > args.tolerance:
+                    errors.append("%s: %s %.3f, expected %.3f" % (name, key, result[key], want[key]))
+            if result["longtail"] != want["longtail"]:
+                errors.append("%s: longtail %s, expected %s" % (name, result["longtail"], want["longtail"]))
+        hours = sum(seconds for trackName, _, segments in tracks if trackName in names for seconds, _, _ in segments) / 3600
+
+        print("%-12s %7d %9.2f %9.3f %14.1f %14.1f %9.1f %9.1f %7d" % (path, len(order), run["wall"], len(order) / run["wall"],
+              run["wall"] / hours, run["child_cpu"] / hours, run["rss"], run["child_rss"], len(errors)))
+        for error in errors:
+            print("    %s" % error)
+        passed &= not errors
+
+    print("Corpus: %d tracks, %.2f hours of audio" % (len(tracks), audioHours))
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
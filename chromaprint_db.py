@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 
-import glob, argparse, subprocess, csv, os, sys
+import glob, argparse, subprocess, csv, os, sys, time, concurrent.futures
+import fingerprints
 
 FPCALC = "/usr/local/bin/fpcalc"
 FFPROBE = "/usr/local/bin/ffprobe"
@@ -43,6 +44,19 @@ def intToBitPairs(number):
 
     return ''.join(new_digits).zfill(16)
 
+def fingerprintWords(filename, duration):
+    # The fingerprint of filename as a list of 32-bit words, and the duration fpcalc found
+    checkFingerprint = fingerprint(filename, duration)
+    return (list(map(int, checkFingerprint["chromaprint"].split(","))), checkFingerprint["dur"])
+
+def fingerprintRow(filename, duration):
+    # The row written to the fingerprint database for filename: filename, chromaprint, duration.
+    # Each 32-bit word of the fingerprint is written as 16 base-4 digits.
+    chromaprintList, dur = fingerprintWords(filename, duration)
+    rawBinaryChromaprintList = [intToBitPairs(w) for w in chromaprintList]
+    rawBinaryChromaprint = ','.join(rawBinaryChromaprintList)[:3059]
+    return [filename, rawBinaryChromaprint, dur]
+
 def load_existing_filenames(csv_path):
     """
     Return a set of filenames (first column) already present in the CSV.
@@ -63,63 +77,247 @@ def load_existing_filenames(csv_path):
         print(f"Warning: could not read existing CSV '{csv_path}': {e}", file=sys.stderr)
     return existing
 
+def read_database(csv_path):
+    """
+    Return the rows of the CSV database, keyed by filename, in file order.
+    When a filename appears more than once, the last row wins.
+    """
+    rows = {}
+    if os.path.exists(csv_path):
+        with open(csv_path, 'r', newline='', encoding='utf-8') as fd:
+            for row in csv.reader(fd):
+                if row:
+                    rows[row[0]] = row
+    return rows
+
+def rewrite_database(csv_path, rows):
+    """Write the CSV database afresh, under a temporary name renamed into place."""
+    temporaryFile = csv_path + ".part"
+    with open(temporaryFile, 'w', newline='', encoding='utf-8') as fd:
+        csv.writer(fd).writerows(rows)
+    os.replace(temporaryFile, csv_path)
+
+def safeAudioHash(filename):
+    try:
+        return fingerprints.audioHash(filename)
+    except (subprocess.CalledProcessError, OSError) as e:
+        print(f"Warning: could not hash '{filename}': {e}", file=sys.stderr)
+        return None
+
+def planScan(root, store, database, state, jobs):
+    """
+    Compare the .mka files under root with the scan state and the database.
+    Moved and renamed files are linked to the fingerprint of the same audio, and the
+    fingerprints of files that have gone, or whose audio has changed, are dropped.
+    Returns the files that need fingerprinting, and the (size, mtime, hash) of each,
+    to be recorded in the scan state once they are done.
+    """
+    scanned = fingerprints.scanTree(root)
+    print("We found %s .mka files under %s." % (len(scanned), root))
+    rows = read_database(database) if store is None else None
+    known = store.known if store is not None else rows
+
+    # Only files that are new, or whose size or mtime have changed, need their audio hash
+    changed = [f for f, (size, mtime) in scanned.items()
+               if state.get(f) is None or state.get(f)[:2] != (size, mtime) or f not in known]
+    print("%s file(s) are new or changed since the last scan." % len(changed))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        hashes = dict(zip(changed, executor.map(safeAudioHash, changed)))
+
+    # Audio already fingerprinted, by hash, to re-link moved files to
+    byHash = {}
+    for f, (size, mtime, hashout) in state.files.items():
+        if f in known:
+            byHash.setdefault(hashout, f)
+
+    to_process = []
+    pending = {}
+    stale = set()
+    links = []
+    for f in changed:
+        hashout = hashes[f]
+        if hashout is None:
+            continue
+        size, mtime = scanned[f]
+        old = state.get(f)
+        if f in known and (old is None or old[2] == hashout):
+            # The same audio: re-tagged, or fingerprinted before its scan was recorded
+            state.put(f, size, mtime, hashout)
+            byHash.setdefault(hashout, f)
+            continue
+        if f in known:
+            # The audio has changed, so the old fingerprint is wrong
+            stale.add(f)
+        source = byHash.get(hashout)
+        if source is not None and source not in stale:
+            # The link replaces any old fingerprint of f, so f mustn't be dropped as stale too
+            links.append((source, f))
+            stale.discard(f)
+            state.put(f, size, mtime, hashout)
+            continue
+        to_process.append(f)
+        pending[f] = (size, mtime, hashout)
+
+    # Fingerprints of files under root that have gone, which includes the old names of moved files
+    gone = [f for f in list(known) if f not in scanned and fingerprints.underRoot(root, f)]
+    stale.update(gone)
+    for f in gone:
+        state.remove(f)
+
+    if store is not None:
+        # Linking adds an entry for f after its old one, if it had one. Only the old one goes.
+        replaced = set(f for _, f in links if f in known)
+        linked = len(store.filenames)
+        for source, f in links:
+            store.link(source, f)
+        if stale or replaced:
+            store.remove(stale | replaced, before=linked)
+    else:
+        for source, f in links:
+            rows[f] = [f] + rows[source][1:]
+        if stale or links:
+            rewrite_database(database, [row for f, row in rows.items() if f not in stale])
+
+    print("Re-linked %s moved or renamed file(s), and dropped %s fingerprint(s) of files gone or changed." % \
+          (len(links), len(stale)))
+    return to_process, pending
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Automatically fingerprint file(s) containing audio",
+        epilog="For support, contact john@johnwarburton.net"
+    )
+    parser.add_argument("files", help="Path of files; shell-style wildcards are accepted. "
+                        "With --recursive, a directory to scan", nargs="?", type=str)
+    parser.add_argument("-r", "--recursive", help="Scan the whole directory tree, fingerprinting only new or changed audio, "
+                        "and following files that have been moved or renamed", action="store_true")
+    parser.add_argument("--scan-state", help="File recording the size, modification time and audio hash of each file "
+                        "fingerprinted by --recursive (default: '-scan.jsonl' suffix on the output database)", type=str)
+    parser.add_argument("-d", "--duration", help="Duration, in seconds, of audio in fingerprint. Default: 30", default=30, type=int)
+    parser.add_argument("-o", "--output", help="Output database (appends/creates). Default: chromaprints.csv", default="chromaprints.csv", type=str)
+    parser.add_argument("-s", "--store", help="Directory of a binary fingerprint store, used instead of the CSV database. "
+                        "About a quarter of the size, and read without parsing", type=str)
+    parser.add_argument("--import-csv", help="Add the fingerprints in this CSV database to the store", type=str)
+    parser.add_argument("--export-csv", help="Write the whole store to this CSV database, in the usual format", type=str)
+    parser.add_argument("-j", "--jobs", help="Number of files to fingerprint at once. Default: 1", default=1, type=int)
+    parser.add_argument("-f", "--failures", help="CSV file listing the files that couldn't be fingerprinted, and why "
+                        "(default: '-failures.csv' suffix on the output database)", type=str)
+    args = parser.parse_args()
+
+    files = args.files
+    database = args.output
+    duration = args.duration
+    failuresFile = args.failures or os.path.splitext(args.store.rstrip(os.sep) if args.store else database)[0] + "-failures.csv"
+    store = fingerprints.FingerprintStore(args.store) if args.store else None
+
+    if (args.import_csv or args.export_csv) and store is None:
+        parser.error("--import-csv and --export-csv need a --store")
+    if args.import_csv:
+        print("Added %s fingerprint(s) from %s to %s." % (store.importCSV(args.import_csv), args.import_csv, args.store))
+    if args.export_csv:
+        print("Wrote %s fingerprint(s) from %s to %s." % (store.exportCSV(args.export_csv), args.store, args.export_csv))
+    if not files:
+        if not (args.import_csv or args.export_csv):
+            parser.error("no files given")
+        return
+
+    state = None
+    pending = {}
+    if args.recursive:
+        # 1-2) Scan the tree, and keep only what has changed since the last scan
+        state = fingerprints.ScanState(args.scan_state or (os.path.join(args.store, "scan.jsonl") if store is not None \
+                                       else os.path.splitext(database)[0] + "-scan.jsonl"))
+        to_process, pending = planScan(files, store, database, state, args.jobs)
+        if store is not None:
+            database = args.store
+        print("We will fingerprint %s new or changed file(s)." % len(to_process))
+    else:
+        # 1) Collect candidate files and restrict to .mka (single directory)
+        filenameList = [f for f in patternToList(files) if f.endswith(".mka")]
+        print("We found %s .mka files." % len(filenameList))
+
+        # 2) Load existing filenames from CSV (or the store) and skip them
+        if store is not None:
+            database = args.store
+            existing_filenames = store.known
+        else:
+            existing_filenames = load_existing_filenames(database)
+        to_process = [f for f in filenameList if f not in existing_filenames]
+
+        print("Skipping %s already fingerprinted file(s) in %s." % (len(filenameList) - len(to_process), database))
+        print("We will fingerprint %s new file(s)." % len(to_process))
+
+    if not to_process:
+        if state is not None:
+            state.compact()
+        print("Nothing to do; all matching files already exist in the CSV.")
+        return
+
+    # 3) Progress indicator formatting: [xx/nnnn] where nnnn == len(to_process)
+    total = len(to_process)
+    width_total = max(4, len(str(total)))  # at least 4 digits for the total, as requested
+    width_idx = max(2, len(str(total)))    # at least 2 digits for the index
+
+    # 4) Append new rows to CSV in a single open, in the order the files are finished.
+    # fpcalc does the work in child processes, so threads are enough to keep the cores busy.
+    # Only this thread writes to the CSV. A file fpcalc can't read is listed in the failures
+    # file, and left out of the database so that it is tried again next time.
+    failures = 0
+    started = time.monotonic()
+    with open(os.devnull if store is not None else database, 'a', newline='', encoding='utf-8') as fd, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        csvWriter = csv.writer(fd)
+        futures = {executor.submit(fingerprintWords if store is not None else fingerprintRow, filename, duration): filename
+                   for filename in to_process}
+        for i, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            filename = futures[future]
+            elapsed = time.monotonic() - started
+            rate = i / elapsed if elapsed > 0 else 0.0
+            eta = time.strftime("%H:%M:%S", time.gmtime((total - i) / rate)) if rate > 0 else "--:--:--"
+            progress = f"[{str(i).zfill(width_idx)}/{str(total).zfill(width_total)}] {rate:.1f} files/s, ETA {eta}"
+            print(f"{progress} {filename}")
+
+            # Fingerprint the file
+            try:
+                row = future.result()
+            except (subprocess.CalledProcessError, OSError, IndexError, ValueError) as e:
+                print(f"Warning: could not fingerprint '{filename}': {e}", file=sys.stderr)
+                with open(failuresFile, 'a', newline='', encoding='utf-8') as failed:
+                    csv.writer(failed).writerow([filename, str(e)])
+                failures += 1
+                continue
+
+            if store is not None:
+                # The store takes the words as they are
+                words, dur = row
+                print("For file %s, we have a fingerprint of %s words" % (filename, len(words)))
+                store.append(filename, words, dur)
+                if filename in pending:
+                    state.put(filename, *pending[filename])
+                continue
+
+            rawBinaryChromaprint = row[1]
+
+            # Diagnostics (kept as in your original script)
+            print("For file %s," % filename)
+            print("...we have fingerprint:")
+            print(rawBinaryChromaprint)
+            print("of length %s" % len(rawBinaryChromaprint))
+
+            # Write the row: filename, chromaprint, duration
+            csvWriter.writerow(row)
+            if filename in pending:
+                # The row must be on disk before the scan state says the file is done
+                fd.flush()
+                state.put(filename, *pending[filename])
+
+    if state is not None:
+        state.compact()
+    if failures:
+        print("%s file(s) could not be fingerprinted. They are listed in %s." % (failures, failuresFile))
+    print("Done.")
+
 
-parser = argparse.ArgumentParser(
-    description="Automatically fingerprint file(s) containing audio",
-    epilog="For support, contact john@johnwarburton.net"
-)
-parser.add_argument("files", help="Path of files; shell-style wildcards are accepted.", type=str)
-parser.add_argument("-d", "--duration", help="Duration, in seconds, of audio in fingerprint. Default: 30", default=30, type=int)
-parser.add_argument("-o", "--output", help="Output database (appends/creates). Default: chromaprints.csv", default="chromaprints.csv", type=str)
-args = parser.parse_args()
-
-files = args.files
-database = args.output
-duration = args.duration
-
-# 1) Collect candidate files and restrict to .mka (single directory)
-filenameList = [f for f in patternToList(files) if f.endswith(".mka")]
-print("We found %s .mka files." % len(filenameList))
-
-# 2) Load existing filenames from CSV and skip them
-existing_filenames = load_existing_filenames(database)
-to_process = [f for f in filenameList if f not in existing_filenames]
-
-print("Skipping %s already fingerprinted file(s) in %s." % (len(filenameList) - len(to_process), database))
-print("We will fingerprint %s new file(s)." % len(to_process))
-
-if not to_process:
-    print("Nothing to do; all matching files already exist in the CSV.")
-    sys.exit(0)
-
-# 3) Progress indicator formatting: [xx/nnnn] where nnnn == len(to_process)
-total = len(to_process)
-width_total = max(4, len(str(total)))  # at least 4 digits for the total, as requested
-width_idx = max(2, len(str(total)))    # at least 2 digits for the index
-
-# 4) Append new rows to CSV in a single open
-with open(database, 'a', newline='', encoding='utf-8') as fd:
-    csvWriter = csv.writer(fd)
-    for i, filename in enumerate(to_process, start=1):
-        progress = f"[{str(i).zfill(width_idx)}/{str(total).zfill(width_total)}]"
-        print(f"{progress} {filename}")
-
-        # Fingerprint the file
-        checkFingerprint = fingerprint(filename, duration)
-
-        # Your existing transformation
-        chromaprintList = list(map(int, checkFingerprint["chromaprint"].split(",")))
-        dur = checkFingerprint["dur"]
-        rawBinaryChromaprintList = [intToBitPairs(w) for w in chromaprintList]
-        rawBinaryChromaprint = ','.join(rawBinaryChromaprintList)[:3059]
-
-        # Diagnostics (kept as in your original script)
-        print("For file %s," % filename)
-        print("...we have fingerprint:")
-        print(rawBinaryChromaprint)
-        print("of length %s" % len(rawBinaryChromaprint))
-
-        # Write the row: filename, chromaprint, duration
-        csvWriter.writerow([filename, rawBinaryChromaprint, dur])
-
-print("Done.")
+if __name__ == "__main__":
+    main()
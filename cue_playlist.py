@@ -1,32 +1,225 @@
 #!/usr/bin/python3
 # This program is superseded by nocue_playlist.py because Liquidsoap now handles
 # all cueing itself.
-import subprocess, argparse, os, os.path, random, string, tempfile, csv, re
-from pathlib import Path
+import subprocess, argparse, os, os.path, random, string, tempfile, csv, re, concurrent.futures
+import ingest
+import r128
 
 FFMPEG = "/usr/local/bin/ffmpeg"
+FFPROBE = "/usr/local/bin/ffprobe"
 FPCALC = "/usr/local/bin/fpcalc"
 MEZZANINE = "-acodec libfdk_aac -vbr 5 -ac 2 -map 0:a"
 MD5HashRE = re.compile(r'(?i)(?<![a-z0-9])[a-f0-9]{32}(?![a-z0-9])')
+# Written into every mezzanine file with its measurements. Change this whenever the way cue points
+# are measured changes, so that files tagged by an older version aren't trusted.
+TAG_VERSION = "2"
+
+def audioChannels(filename):
+    # Number of channels and channel layout of the first audio stream
+    test = subprocess.check_output([FFPROBE, "-v", "quiet", "-select_streams", "a:0", \
+            "-show_entries", "stream=channels,channel_layout", "-of", "default=noprint_wrappers=1", filename], \
+            encoding='utf-8').splitlines()
+    fields = dict(line.split("=", 1) for line in test if "=" in line)
+    return(int(fields["channels"]), fields.get("channel_layout"))
+
+def loudnessSeries(filename, withHash=False, engine="ffmpeg", start=None, length=None):
+    # Runs the EBU R.128 meter over filename and returns a dictionary holding the
+    # times and momentary loudnesses of every 1/10 sec frame, as two float arrays,
+    # the integrated loudness and the duration, and also the highest short-term loudness,
+    # the loudness range and the true-peak, all from the same decode.
+    # If withHash is set, the MD5 content hash (as used in mezzanine filenames) is
+    # computed in the same FFmpeg run: the audio is read and decoded only once, and the
+    # decoded audio is fed both to the hash muxer and to the loudness meter.
+    # With engine="ffmpeg", FFmpeg's ebur128 filter does the measuring and prints its results.
+    # With engine="numpy", FFmpeg only decodes, and r128.LoudnessMeter measures the raw samples.
+    # If start or length (in seconds) are given, only that part of the file is decoded and measured.
+    # The times returned are still measured from the start of the file.
 
-def analyse(filename, volDrop, volStart=40, mezzanine=None, forceEncode=False):
+    # We pass "-vn" because some music files have invalid images, which can't be processed by ffmpeg
+    command = [FFMPEG, "-hide_banner", "-y", "-v", "quiet"]
+    if start:
+        command += ["-ss", '{:.3f}'.format(start)]
+    if length:
+        command += ["-t", '{:.3f}'.format(length)]
+    command += ["-i", filename]
+    if withHash:
+        # The hash can't go to stdout, because the loudness measurements are printed there.
+        hashFile = tempfile.NamedTemporaryFile(delete=False, suffix=".md5").name
+        command += ["-vn", "-map", "0:a", "-f", "hash", "-hash", "MD5", hashFile]
+    if engine == "numpy":
+        channels, layout = audioChannels(filename)
+        command += ["-vn", "-map", "0:a:0", "-ar", str(r128.SAMPLE_RATE), "-f", "f32le", "-"]
+    else:
+        command += ["-vn", "-af", "ebur128=metadata=1:peak=true,ametadata=mode=print:file=-", "-f", "null", "null"]
+
+    try:
+        # The measurements are taken as FFmpeg produces its output, so a long file never has
+        # all of it held in memory.
+        if engine == "numpy":
+            with subprocess.Popen(command, stdout=subprocess.PIPE) as proc:
+                with ingest.stage(filename, "parse"):
+                    series = r128.measurePCM(proc.stdout, channels, r128.channelWeights(channels, layout))
+        else:
+            with subprocess.Popen(command, stdout=subprocess.PIPE, encoding='utf-8') as proc:
+                with ingest.stage(filename, "parse"):
+                    series = r128.readFrames(proc.stdout)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, command)
+        if withHash:
+            # The hash muxer writes a single line: MD5=<32 hex digits>
+            with open(hashFile) as h:
+                series["hash"] = h.read().strip().split("=")[-1]
+        else:
+            series["hash"] = None
+    finally:
+        if withHash:
+            os.remove(hashFile)
+
+    if start:
+        series["times"] = series["times"] + start
+        series["duration"] += start
+    return(series)
+
+def probeTags(filename):
+    # Returns the tags of the first audio stream, with lower-case names, and the file's duration.
+    # Mezzanine files made by analyse() carry their measurements in these tags.
+    test = subprocess.check_output([FFPROBE, "-v", "quiet", "-select_streams", "a:0", \
+            "-show_entries", "format=duration:stream_tags", "-of", "default=noprint_wrappers=1", filename], \
+            encoding='utf-8').splitlines()
+    tags = {}
+    duration = None
+    for line in test:
+        key, sep, value = line.partition("=")
+        if key.startswith("TAG:"):
+            tags[key[4:].lower()] = value
+        elif key == "duration":
+            try:
+                duration = float(value)
+            except ValueError:
+                pass
+    return(tags, duration)
+
+def tagDuration(value):
+    # Durations in tags are either seconds, or HH:MM:SS.nnnnnnnnn as written by the Matroska muxer
+    seconds = 0.0
+    for part in value.split(":"):
+        seconds = seconds * 60 + float(part)
+    return(seconds)
+
+def taggedLevels(tags):
+    # The true-peak, loudness range and highest short-term loudness tagged in a mezzanine file,
+    # each None if it isn't there
+    levels = {}
+    for key, tag in (("true_peak", "true_peak"), ("lra", "loudness_range"), ("short_term_max", "max_short_term")):
+        try:
+            levels[key] = float(tags[tag])
+        except (KeyError, ValueError):
+            levels[key] = None
+    return(levels)
+
+def taggedCuePoints(probed, volDrop, volStart):
+    # A mezzanine file carries the results of the analysis that made it. If they were made by this
+    # version, with the same levels, they are used as they are. Returns (series, candidates), or None
+    # if the tags are missing or stale.
+    tags, fileDuration = probed
+    try:
+        if tags["cue_version"] != TAG_VERSION or float(tags["cue_level"]) != volDrop or float(tags["cue_start"]) != volStart:
+            return(None)
+        loudness = float(tags["loudness"])
+        duration = tagDuration(tags["duration"]) if "duration" in tags else fileDuration
+        startNext = float(tags["liq_cross_duration"])
+        candidate = {"volDrop": volDrop, "volStart": volStart, "cue_point": float(tags["liq_cue_in"]),
+                     "start_next": startNext, "next_time": duration - startNext, "longtail": tags["longtail"]}
+    except (KeyError, ValueError, TypeError):
+        return(None)
+    print("Using the measurements tagged in the file.")
+    series = {"times": None, "momentary": None, "loudness": loudness, "duration": duration, "hash": None}
+    series.update(taggedLevels(tags))
+    return(series, [candidate])
+
+def windowedCuePoints(filename, probed, thresholds, head, tail, engine="ffmpeg"):
+    # When a mezzanine file's loudness tag already gives its integrated loudness, the cue-in point
+    # can be found from its first few seconds, and the fade-out from its last few, without
+    # decoding the rest. Returns (series, candidates), or None if the file has no loudness tag,
+    # is too short for this to save anything, or a cue point isn't inside the windows.
+    # probed is what probeTags() returned for the file.
+    tags, fileDuration = probed
+    try:
+        loudness = float(tags["loudness"])
+    except (KeyError, ValueError):
+        return(None)
+    if not fileDuration or fileDuration <= head + tail:
+        return(None)
+
+    # Start the tail on the same 1/10 sec grid as a measurement of the whole file
+    tailStart = int((fileDuration - tail) * 10) / 10.0
+    headSeries = loudnessSeries(filename, engine=engine, length=head)
+    tailSeries = loudnessSeries(filename, engine=engine, start=tailStart)
+    # As for the whole file, the duration is the time of the last frame
+    duration = tailSeries["duration"]
+
+    candidates = r128.findCuePointsInWindows(headSeries, tailSeries, tailStart, loudness, duration, thresholds)
+    if candidates is None:
+        return(None)
+    print("Measured %.1fs at the start and %.1fs at the end, using tagged loudness." % (head, duration - tailStart))
+    series = {"times": None, "momentary": None, "loudness": loudness, "duration": duration, "hash": None}
+    # The whole file's peak and range are only known if they were tagged too
+    series.update(taggedLevels(tags))
+    return(series, candidates)
+
+def mediaHash(filename):
+    # MD5 hash of the decoded audio, as used to make mezzanine filenames unique
+    hashout = str(subprocess.check_output([FFMPEG, "-v", "quiet", "-hide_banner", "-i", filename, "-vn", \
+            "-map", "0:a", "-f", "hash", "-hash", "MD5", "-"], stderr=subprocess.STDOUT))[6:-3]
+    return(hashout)
+
+def analyse(filename, volDrop, volStart=40, mezzanine=None, forceEncode=False, singlePass=False, tryLevels=None, seriesCache=None, hashCacheFile=None, fastHash=False, hashMapFile=None, engine="ffmpeg", windowed=None, trustTags=False, adopt=False, order=None):
     # Analyses file in filename, returns seconds to end-of-file of place where volume last drops to level
     # below average loudness, given in volDrop in LU.
     # Also determines file start, where monentary loudness leaps above a certain point given by volStart
     # Also encode and store a mezzanine file, if a mezzanine directory name is given
+    # If singlePass is set, the content hash and the loudness measurements are taken from
+    # one decode of the file, instead of decoding it once for each.
+    # tryLevels is an optional list of further (volDrop, volStart) pairs: cue points for these
+    # are returned as "candidates", alongside those for volDrop and volStart, for comparison.
+    # If seriesCache names a directory, the loudness measurements are kept there, so that
+    # a later run with different thresholds needn't decode the file again.
+    # If hashCacheFile is given, content hashes are looked up there by the source's inode, size
+    # and modification time before decoding the file to hash it.
+    # If fastHash is set, the compressed packets are hashed first, and hashMapFile translates them
+    # to decoded-audio hashes. Only audio it doesn't know yet is decoded.
+    # engine chooses the loudness meter: FFmpeg's ebur128 filter, or the NumPy one in r128.py.
+    # windowed is an optional (head, tail) pair of window lengths in seconds. When the file is tagged
+    # with its loudness, only those windows at its start and end are measured, if they are enough.
+    # If trustTags is set, the measurements tagged in a mezzanine file are used without measuring
+    # again, when they were made by this version with the same levels.
+    # If adopt is set, a mezzanine file already in the directory under the very name this track
+    # would be given is taken as made for it by an interrupted run: the track is measured, but
+    # not encoded again, instead of being skipped.
+    # order is the track's position in the playlist. Tracks with the same audio claim it in this
+    # order, so the first of them is the one encoded, as when they are processed one at a time.
 
     # Make a list containing many points, 1/10 sec apart, where loudness is measured.
     # We need TIME and MOMENTARY LOUDNESS
     # We also need full INTEGRATED LOUDNESS
 
     print("Processing filename: %s" % filename)
+    series = None
     # If we're being asked to create a mezzanine file, we need to make a unique suffix for this file
     # but the suffix MUST be related to the file's contents, to be able to identify the file
     # so that we do not waste time encoding it twice. FFmpeg provides a hash function for this.
     # Incidentally, this might be a way of detecting duplicate tracks, too.
     if mezzanine:
-        hashout = str(subprocess.check_output([FFMPEG, "-v", "quiet", "-hide_banner", "-i", filename, "-vn", \
-                "-map", "0:a", "-f", "hash", "-hash", "MD5", "-"], stderr=subprocess.STDOUT))[6:-3]
+        def decodedHash():
+            nonlocal series
+            if singlePass:
+                series = loudnessSeries(filename, withHash=True, engine=engine)
+                return(series["hash"])
+            return(mediaHash(filename))
+
+        # An unchanged source that has been hashed before is recognised from its stat() alone.
+        with ingest.stage(filename, "hash"):
+            hashout = ingest.contentHash(filename, decodedHash, fast=fastHash, cacheFile=hashCacheFile, mapFile=hashMapFile)
 
         print("MD5 hash is: %s" % hashout)
         #randomString = ''.join(random.choice(string.ascii_letters) for i in range(6))
@@ -60,250 +253,384 @@ def analyse(filename, volDrop, volStart=40, mezzanine=None, forceEncode=False):
         # If it contains an entry, the track has already been converted, and we
         # need to abandon the process.
         print("Looking for file containing hash.")
-        p = Path(mezzanine+'/')
-        findMe = mezzanine + '/' + '[FILENAME]' + hashout + '*.mka'
-        print("Path object is:", p)
-        print("Glob search is:", findMe)
-        pl = list(p.glob('*'+hashout+'*.mka'))
-        if len(pl) != 0: # There is already a file with this hash
+        # The index lists the mezzanine directory once per run, rather than globbing it for every
+        # track. Claiming the hash also stops two workers encoding the same audio at once.
+        index = ingest.mezzanineIndex(mezzanine)
+        with ingest.stage(filename, "index"):
+            index.waitTurn(order)
+            claimed = index.claim(hashout, mezzanineName)
+            adopted = not claimed and adopt and index.adopt(hashout, mezzanineName)
+            index.passTurn(order)
+        if adopted:
+            print("This track's mezzanine file was made by an interrupted run. Not encoding.")
+        elif not claimed:
             print("This hash already exists! Not encoding.")
             return(None)
-        print("No file found with that hash. Encoding.")
+        else:
+            print("No file found with that hash. Encoding.")
 
     else:
         mezzanineName = None
 
-    # We pass "-vn" because some music files have invalid images, which can't be processed by ffmpeg
 #   Get working on this:  ffmpeg -v quiet -i mez3/Rafe_Gomez_Icy.17d3cf4a75edd765b5981c5e8322a4dc.mka -vn -af ebur128=metadata=1,ametadata=mode=print:file=- -f null null
+    # If anything goes wrong from here on, give up the claim on the hash, so that the file
+    # is tried again instead of being taken as already ingested.
+    try:
+        # Loudness measurements are cached by the hash of the audio. Without a mezzanine directory
+        # we haven't computed a hash, but a file that is already a mezzanine carries one in its name.
+        if mezzanine:
+            seriesKey = hashout
+        else:
+            searchCheck = re.search(MD5HashRE, os.path.basename(filename))
+            seriesKey = searchCheck.group(0) if searchCheck else None
+
+        # Every threshold pair asked for is searched in the same pass over the measurements.
+        # The first pair is the one used for the playlist and the mezzanine file.
+        thresholds = [(volDrop, volStart)] + list(tryLevels or [])
+        candidates = None
+
+        # Tags can only stand in for the measurements when no other levels are being tried
+        probed = None
+        if series is None and ((trustTags and len(thresholds) == 1) or windowed):
+            with ingest.stage(filename, "tags"):
+                probed = probeTags(filename)
+        if series is None and trustTags and len(thresholds) == 1:
+            found = taggedCuePoints(probed, volDrop, volStart)
+            if found:
+                series, candidates = found
+
+        cached = False
+        if series is None and seriesCache:
+            with ingest.stage(filename, "cache"):
+                series = r128.loadSeries(seriesCache, seriesKey, engine)
+            cached = series is not None
+        if series is None and windowed:
+            with ingest.stage(filename, "windows"):
+                found = windowedCuePoints(filename, probed, thresholds, windowed[0], windowed[1], engine=engine)
+            if found:
+                series, candidates = found
+            else:
+                print("Can't find the cue points from the start and end alone. Measuring the whole file.")
+        if series is None:
+            with ingest.stage(filename, "loudness"):
+                series = loudnessSeries(filename, engine=engine)
+
+        if cached:
+            print("Using cached loudness measurements for hash %s." % seriesKey)
+        elif candidates is not None:
+            # Only part of the file was measured, or none of it: nothing to cache
+            pass
+        elif seriesCache and seriesKey:
+            with ingest.stage(filename, "cache"):
+                r128.saveSeries(seriesCache, seriesKey, series, engine)
+
+        times = series["times"]
+        momentary = series["momentary"]
+        loudness = series["loudness"]
+        duration = series["duration"]
+        truePeak = series.get("true_peak")
+        lra = series.get("lra")
+        shortTermMax = series.get("short_term_max")
+
+        print("Duration is %f" % duration)
+
+        print("Overall loudness is: %f" % loudness)
+        if truePeak is not None:
+            print("True peak is %f dBTP, loudness range %f LU, highest short-term loudness %f LUFS" % (truePeak, lra, shortTermMax))
+
+        # First, let us find the first timestamp where the momentary loudness is volStart below the
+        # track's overall loudness level. That level is cueLevel.
+        # Then we must find the last timestamp where the momentary loudness is volDrop LU below the track's
+        # overall loudness level. That level is nextLevel.
+        if candidates is None:
+            with ingest.stage(filename, "cues"):
+                candidates = r128.findCuePoints(times, momentary, loudness, duration, thresholds)
+
+        print("Desired start detection volume is %f" % volStart)
+        print("We're looking for %f LUFS volume." % (loudness - volStart))
+        cueTime = candidates[0]["cue_point"]
+        print("Starting next track from cue point: %f" % cueTime)
+
+        print("Desired volume lowering is %f" % volDrop)
+        print("We're looking for %f LUFS volume." % (loudness - volDrop))
+        # Little piece of logic to fix "Bohemian Rhapsody" and other songs with a long
+        # but important tail: the trigger level is lowered by 15dB.
+        longTail = candidates[0]["longtail"]
+        nextTime = candidates[0]["next_time"]
+        if longTail == "True":
+            print("This track has a LONG TAIL.")
+            print("We're looking for %f LUFS volume." % (loudness - volDrop - r128.LONG_TAIL))
+        print("Starting next track at time: %f which is %f before end." % (nextTime, duration-nextTime))
+
+        for candidate in candidates[1:]:
+            print("Candidate for level %s, cue %s: cue point %.3f, start next %.3f, long tail %s" % \
+                  (candidate["volDrop"], candidate["volStart"], candidate["cue_point"], candidate["start_next"], candidate["longtail"]))
+
+        # At this point, the file of interest is EITHER the original file, OR a mezzanine name.
+        # ONLY IF we've made a mezzanine name, we want to add some metadata to show our working.
+        if mezzanine and adopted:
+            print("Keeping the mezzanine file made by the interrupted run.")
+        elif mezzanine:
+            print("Creating mezzanine file with added metadata.")
+
+            # Let's write the metadata, in case it's useful to somebody else
+            # We need a temporary filename for FFmpeg to write to. We can't write metadata in place, because
+            # the position of other elements in the file would change.
+            # It sits beside the mezzanine file, so the final rename is atomic: a run that dies part way
+            # through never leaves a truncated file that looks like a finished mezzanine.
+            temporaryFile = mezzanineName + ".part"
+            levelTags = []
+            if truePeak is not None:
+                levelTags = ["-metadata:s:a:0", "true_peak="+'{:.3f}'.format(truePeak), \
+                             "-metadata:s:a:0", "loudness_range="+'{:.3f}'.format(lra), \
+                             "-metadata:s:a:0", "max_short_term="+'{:.3f}'.format(shortTermMax)]
+            with ingest.stage(filename, "remux"):
+                # -y, because a .part file left by a run that crashed is overwritten without asking.
+                remuxCommand = [FFMPEG, "-hide_banner", "-nostdin", "-y", "-i", filename, \
+                        # "-vn", "-acodec", "libfdk_aac", "-vbr", "5", "-ar", "48000", "-ac", "2", \
+                        "-vn", "-acodec", "copy", \
+                        "-metadata:s:a:0", "longtail="+longTail, \
+                        "-metadata:s:a:0", "liq_cross_duration="+'{:.3f}'.format(max(duration-nextTime,0)), \
+                        "-metadata:s:a:0", "liq_fade_out_delay="+'{:.3f}'.format(max(duration-nextTime,0)), \
+                        "-metadata:s:a:0", "liq_cue_in="+'{:.3f}'.format(cueTime), \
+                        "-metadata:s:a:0", "duration="+'{:.3f}'.format(duration), \
+                        "-metadata:s:a:0", "loudness="+'{:.3f}'.format(loudness), \
+                        "-metadata:s:a:0", "cue_level="+'{:g}'.format(volDrop), \
+                        "-metadata:s:a:0", "cue_start="+'{:g}'.format(volStart), \
+                        "-metadata:s:a:0", "cue_version="+TAG_VERSION] + levelTags + ["-f", "matroska", temporaryFile]
+                # Don't leave a half-written file behind if FFmpeg fails or the run is interrupted.
+                try:
+                    test = str(subprocess.check_output(remuxCommand, stderr=subprocess.STDOUT)).split('\\n')
+                    os.replace(temporaryFile, mezzanineName)
+                except BaseException:
+                    if os.path.exists(temporaryFile):
+                        os.remove(temporaryFile)
+                    raise
+        else:
+            print("We are NOT adding metadata to any file.")
+    except BaseException:
+        if mezzanine:
+            ingest.mezzanineIndex(mezzanine).release(hashout, mezzanineName)
+        raise
     if mezzanine:
-        test = str(subprocess.check_output([FFMPEG, "-hide_banner", "-v", "quiet", "-i", filename, "-vn", "-af", \
-                                            "ebur128=metadata=1,ametadata=mode=print:file=-", "-f", "null", "null"], encoding='utf-8')).splitlines()
-    else:
-        test = str(subprocess.check_output([FFMPEG, "-hide_banner", "-y", "-v", "quiet", "-i", filename, "-vn", "-af", \
-                                            "ebur128=metadata=1,ametadata=mode=print:file=-", "-f", "null", "null"], encoding='utf-8')).splitlines()
-
-    # Let's divide the measurements into frames. Each frame consists of SEVEN lines
-    framesLength = len(test)
-    #print(framesLength)
-    #print(test)
-
-    if framesLength % 7 != 0:
-        print("Oops. EBU R.128 frames output has extra/missing lines.")
-        exit(-1)
-
-    framesList = []
-
-    for index in range(framesLength // 7):
-        framesList.append([])
-        for increment in range(6):
-            framesList[index].append(test[(index*7) + increment])
-    # We now have a list of lists. Every lower-level list is a frame. The main list is frame-by-frame.
-
-    # print(framesList)
-
-    measure = []
-
-    # We need a list of times and momentary loudnesses.
-    # We also need the overall integrated loudness.
-    # We also need the proper duration of this file.
-
-    for frame in framesList:
-        frameTime = frame[0].split(":")[-1]
-        frameLoudness = [i for i in frame if i.startswith('lavfi.r128.M=')][0].split("=")[-1]
-        measure.append([float(frameTime), float(frameLoudness)])
-
-    #    print(measure)
-
-    # measure now contains a list of lists-of-floats: each item is [time],[loudness]
-    # Now we need overall loudness. This is the lavfi.r128.I value in the very last line
-
-    loudness = float([i for i in framesList[-1] if i.startswith('lavfi.r128.I=')][0].split("=")[-1])
-
-    # Get duration. It's the frame pts given in the last frame.
-
-    duration = float(framesList[-1][0].split(":")[-1])
-
-    print("Duration is %f" % duration)
-
-    print("Overall loudness is: %f" % loudness)
-
-    # First, let us find the first timestamp where the momentary loudness is volStart below the
-    # track's overall loudness level. That level is cueLevel
-
-    print("Desired start detection volume is %f" % volStart)
-    cueLevel = loudness - volStart
-    print("We're looking for %f LUFS volume." % cueLevel)
-    # Set a sensible default if we can't find a start
-    ebuCueTime=0.0
-
-    for item in measure:
-        if item[1] > cueLevel:
-            ebuCueTime = item[0]
-            break
-    # The EBU R.128 algorithm measures in 400ms blocks. Therefore, it marks 0.4s as the
-    # start of the track, even if its audio begins at 0.0s. So, we must subtract 400ms
-    # from the given time, then use either that time, or 0.0s (if the result is negative)
-    # as our track starting point.
-    # We then take it back by a further 0.2s for safety -- NOT YET
-    cueTime = max(0, ebuCueTime-0.4)
-
-    print("Starting next track from cue point: %f" % cueTime)
-
-    # Now we must find the last timestamp where the momentary loudness is volDrop LU below the track's
-    # overall loudness level. That level is nextLevel.
-    # We'll reverse the list
-    measure.reverse()
-    print("Desired volume lowering is %f" % volDrop)
-    nextLevel = loudness - volDrop
-    print("We're looking for %f LUFS volume." % nextLevel)
-    # Set a sensible default if we can't find a drop
-    nextTime=0.0
-
-    for item in measure:
-        if item[1] > nextLevel:
-            nextTime = item[0]
-            break
-    print("Starting next track at time: %f which is %f before end." % (nextTime, duration-nextTime))
-    # Little piece of logic to fix "Bohemian Rhapsody" and other songs with a long
-    # but important tail.
-
-    longTail = "False"
-
-    if (duration-nextTime) > 15.0:
-        longTail = "True"
-        print("This track has a LONG TAIL.")
-        print("Lowering next track trigger level by 15dB.")
-        nextLevel = loudness - volDrop - 15.0
-        print("We're looking for %f LUFS volume." % nextLevel)
-        # Set a sensible default if we can't find the right drop
-        nextTime = 0.0
-
-        for item in measure:
-            if item[1] > nextLevel:
-                nextTime = item[0]
-                break
-        print("Starting next track at NEW time: %f which is %f before end." % (nextTime, duration-nextTime))
-
-    # At this point, the file of interest is EITHER the original file, OR a mezzanine name.
-    # ONLY IF we've made a mezzanine name, we want to add some metadata to show our working.
-    if mezzanine:
-        print("Creating mezzanine file with added metadata.")
-
-        # Let's write the metadata, in case it's useful to somebody else
-        # We need a temporary filename for FFmpeg to write to. We can't write metadata in place, because
-        # the position of other elements in the file would change.
-        temporaryFile = tempfile.NamedTemporaryFile(delete=False).name + ".mka"
-        test = str(subprocess.check_output([FFMPEG, "-hide_banner", "-i", filename, \
-                # "-vn", "-acodec", "libfdk_aac", "-vbr", "5", "-ar", "48000", "-ac", "2", \
-                "-vn", "-acodec", "copy", \
-                "-metadata:s:a:0", "longtail="+longTail, \
-                "-metadata:s:a:0", "liq_cross_duration="+'{:.3f}'.format(max(duration-nextTime,0)), \
-                "-metadata:s:a:0", "liq_fade_out_delay="+'{:.3f}'.format(max(duration-nextTime,0)), \
-                "-metadata:s:a:0", "liq_cue_in="+'{:.3f}'.format(cueTime), \
-                "-metadata:s:a:0", "duration="+'{:.3f}'.format(duration), \
-                "-metadata:s:a:0", "loudness="+'{:.3f}'.format(loudness), temporaryFile], \
-                stderr=subprocess.STDOUT)).split('\\n')
-        os.rename(temporaryFile, mezzanineName)
-    else:
-        print("We are NOT adding metadata to any file.")
+        ingest.mezzanineIndex(mezzanine).finish(hashout)
 
     return({"start_next": max(duration-nextTime,0), "cue_point": cueTime, "duration": duration, \
             "loudness": loudness, "mezzanine_name": mezzanineName,
-            "longtail": longTail})
+            "longtail": longTail, "candidates": candidates, \
+            "true_peak": truePeak, "lra": lra, "short_term_max": shortTermMax})
+
+def playlistLine(result, item, ceiling=None):
+    # The annotated playlist line for item (which ends with a newline), from what analyse() returned
+    # If ceiling is given, in dBTP, liq_amplify is lowered where needed so that the amplified
+    # track's true-peak stays below it.
+    timeRemaining = result["start_next"]
+    cuePoint = result["cue_point"]
+    duration = result["duration"]
+    # liq_fade_out_delay was introduced in liquidsoap 2.2.4 to indiate where any volume
+    # fade, as opposed to crossfade (my default: full overlap), should begin.
+    liq_fade_out_delay = timeRemaining
+    # Here, we calculate replayGain by subtracting the actual loudness of the track from -23
+    # because -23LUFS is our internal standard for loudness.
+    # It's this low because many tracks have peaks way above their loudness level, and these
+    # will distort if raised very far.
+    replayGain = (-23) - result["loudness"]
+    truePeak = result.get("true_peak")
+    if ceiling is not None and truePeak is not None and replayGain + truePeak > ceiling:
+        print("Limiting gain to %.3f dB, to keep the true peak below %.1f dBTP." % (ceiling - truePeak, ceiling))
+        replayGain = ceiling - truePeak
+
+    # Measurements that help to spot tracks that will distort when amplified
+    levels = ""
+    if truePeak is not None:
+        levels = ',true_peak="' + '{:.3f}'.format(truePeak) \
+                + '",' + 'loudness_range="' + '{:.3f}'.format(result["lra"]) \
+                + '",' + 'max_short_term="' + '{:.3f}'.format(result["short_term_max"]) + '"'
+
+    assembly = 'annotate:' + 'liq_cue_in="' + '{:.3f}'.format(cuePoint) \
+            + '",' + 'liq_cross_duration="' + '{:.3f}'.format(timeRemaining) \
+            + '",' + 'liq_fade_out_delay="' + '{:.3f}'.format(liq_fade_out_delay) \
+            + '",' + 'duration="' + '{:.3f}'.format(duration) \
+            + '",' + 'liq_amplify="' + '{:.3f}'.format(replayGain) + "dB" \
+            + '"' + levels + ':' + item
+    return(assembly)
 
 def fingerprint(filename):
     test = subprocess.check_output([FPCALC, "-algorithm", "4", "-overlap", "-length", "30", "-raw", "-plain", "-signed", filename], encoding='utf-8').rstrip('\n')
     return(test)
 
 
-# What's the command?
-parser = argparse.ArgumentParser(description="Create start and end-of-track annotations for playlist.",
-        epilog="For support, contact john@johnwarburton.net")
-parser.add_argument("playlist", help="Playlist file to be processed")
-parser.add_argument("-l", "--level",  help="LU below average loudness to trigger next track.", default=8, type=float)
-parser.add_argument("-c", "--cue", help="LU below average loudness for track cue-in point", default=40, type=float)
-parser.add_argument("-o", "--output", help="Output filename (default: '-processed' suffix)", type=str)
-parser.add_argument("-m", "--mezzanine", help="Directory for mezzanine-format files", type=str)
-args = parser.parse_args()
-
-playlist = args.playlist
-level = float(args.level)
-cue = float(args.cue)
-
-# Construct default output filename if needed
-if args.output:
-    outfile = args.output
-else:
-    outfile = os.path.splitext(playlist)[0] + "-processed.m3u8"
-
-# Check mezzanine directory name and create if needed
-if args.mezzanine:
-    # Convert given path to an absolute path
-    mezzanine = os.path.abspath(args.mezzanine)
-    try:
-        os.makedirs(mezzanine, exist_ok=True)
-        print("Created directory %s for output audio files." % mezzanine)
-    except OSError:
-        print("Sorry, the directory %s is weird. Might be a file?" % mezzanine)
-        exit(1)
-else:
-    mezzanine = None
-
-print("Working on playlist: %s" % playlist)
-print("Looking for levels of %f LU below average loudness" % level)
-print("Writing to %s" % outfile)
-
-with open(playlist) as i:
-    playlistLines = i.readlines()
-
-print("We have read %s items." % len(playlistLines))
-
-with open(outfile, mode="w") as out:
-    out.write("#EXTM3U\n")
-
-    for item in playlistLines:
-        # Skip the M3U indicator
-        if item == "#EXTM3U\n":
-            continue
-        result = analyse(filename=item.strip(), volDrop=level, volStart=cue, mezzanine=mezzanine, forceEncode=False)
-        # analyse() returns None if the audio has already been converted.
-        # At this point, we can skip writing a new line to the playlist, because the file is already
-        # extant, and must have been referenced already within the playlist we're creating.
-        if result==None:
-            continue
-        timeRemaining = result["start_next"]
-        cuePoint = result["cue_point"]
-        duration = result["duration"]
-        # liq_fade_out_delay was introduced in liquidsoap 2.2.4 to indiate where any volume
-        # fade, as opposed to crossfade (my default: full overlap), should begin.
-        liq_fade_out_delay = timeRemaining
-        # Here, we calculate replayGain by subtracting the actual loudness of the track from -23
-        # because -23LUFS is our internal standard for loudness.
-        # It's this low because many tracks have peaks way above their loudness level, and these
-        # will distort if raised very far.
-        replayGain = (-23) - result["loudness"]
-        if result["mezzanine_name"]:
-            # Remember, a file read in lines has a newline on the end of every line
-            item = result["mezzanine_name"] + '\n'
-
-        assembly = 'annotate:' + 'liq_cue_in="' + '{:.3f}'.format(cuePoint) \
-                + '",' + 'liq_cross_duration="' + '{:.3f}'.format(timeRemaining) \
-                + '",' + 'liq_fade_out_delay="' + '{:.3f}'.format(liq_fade_out_delay) \
-                + '",' + 'duration="' + '{:.3f}'.format(duration) \
-                + '",' + 'liq_amplify="' + '{:.3f}'.format(replayGain) + "dB" \
-                + '":' + item
-        print("Writing line:")
-        print(assembly)
-        out.write(assembly)
-        # Fingerprinting is now in a separate program
-        #fing = fingerprint(item.strip())
-        #fd = open('database.csv', 'a')
-        #csvWriter = csv.writer(fd)
-        #csvWriter.writerow([item.strip(), fing])
-        #fd.close()
-        #print("Fingerprint is:")
-        #print(fing)
-print("Done.")
+def main():
+    # What's the command?
+    parser = argparse.ArgumentParser(description="Create start and end-of-track annotations for playlist.",
+            epilog="For support, contact john@johnwarburton.net")
+    parser.add_argument("playlist", help="Playlist file to be processed")
+    parser.add_argument("-l", "--level",  help="LU below average loudness to trigger next track (default: 8). "
+                        "Can be given multiple times: the first is used for the playlist, the rest are written as candidates.", action="append", type=float)
+    parser.add_argument("-c", "--cue", help="LU below average loudness for track cue-in point (default: 40). "
+                        "Can be given multiple times: the first is used for the playlist, the rest are written as candidates.", action="append", type=float)
+    parser.add_argument("-o", "--output", help="Output filename (default: '-processed' suffix)", type=str)
+    parser.add_argument("-m", "--mezzanine", help="Directory for mezzanine-format files", type=str)
+    parser.add_argument("-r", "--resume", help="Carry on from where an interrupted run stopped, using its journal", action="store_true")
+    parser.add_argument("-t", "--timings", help="Record the time taken by each stage for each file as JSON lines "
+                        "in this file, and print a summary at the end", type=str)
+    parser.add_argument("-j", "--jobs", help="Number of tracks to process at once. Default: 1", default=1, type=int)
+    parser.add_argument("-s", "--single-pass", help="Hash and measure loudness from one decode of each file", action="store_true")
+    parser.add_argument("-e", "--engine", help="Loudness meter: FFmpeg's ebur128 filter, or an in-process NumPy meter "
+                        "fed with raw samples. Default: %(default)s", choices=["ffmpeg", "numpy"], default="ffmpeg")
+    parser.add_argument("--series-cache", help="Directory caching each track's loudness measurements, "
+                        "so that levels can be changed without decoding again", type=str)
+    parser.add_argument("--hash-cache", help="File caching the content hash of each source file, "
+                        "so that unchanged files needn't be decoded to be recognised", type=str)
+    parser.add_argument("--fast-hash", help="Identify audio by hashing its compressed packets. Only audio whose packet hash isn't yet in --hash-map is decoded", action="store_true")
+    parser.add_argument("--hash-map", help="File mapping packet hashes to decoded-audio hashes. "
+                        "Read with --fast-hash, and filled in whenever audio is decoded to hash it", type=str)
+    parser.add_argument("-w", "--windowed", help="For files already tagged with their loudness, such as mezzanine files, "
+                        "measure only the start and end of each, falling back to the whole file when that isn't enough", action="store_true")
+    parser.add_argument("--head", help="Seconds measured at the start of each file with --windowed. Default: %(default)s", default=30.0, type=float)
+    parser.add_argument("--tail", help="Seconds measured at the end of each file with --windowed. Default: %(default)s", default=60.0, type=float)
+    parser.add_argument("--trust-tags", help="Use the measurements tagged in mezzanine files made with the same levels, "
+                        "instead of measuring them again", action="store_true")
+    parser.add_argument("--true-peak-ceiling", help="Highest true-peak, in dBTP, that a track may reach once amplified "
+                        "by liq_amplify. The gain of louder tracks is reduced. Default: no limit", type=float)
+    parser.add_argument("--candidates", help="CSV file for the cue points found with every combination of levels "
+                        "(default: '-candidates.csv' suffix, written only when several levels are given)", type=str)
+    args = parser.parse_args()
+    if args.fast_hash and not args.hash_map:
+        parser.error("--fast-hash needs a --hash-map to remember what it has decoded")
+
+    playlist = args.playlist
+    levels = args.level or [8.0]
+    cues = args.cue or [40.0]
+    level = levels[0]
+    cue = cues[0]
+    # Every combination of the levels given. The first is (level, cue).
+    thresholds = [(l, c) for l in levels for c in cues]
+
+    # Construct default output filename if needed
+    if args.output:
+        outfile = args.output
+    else:
+        outfile = os.path.splitext(playlist)[0] + "-processed.m3u8"
+
+    if len(thresholds) > 1:
+        candidatesFile = args.candidates or os.path.splitext(playlist)[0] + "-candidates.csv"
+    else:
+        candidatesFile = None
+
+    # Check mezzanine directory name and create if needed
+    if args.mezzanine:
+        # Convert given path to an absolute path
+        mezzanine = os.path.abspath(args.mezzanine)
+        try:
+            os.makedirs(mezzanine, exist_ok=True)
+            print("Created directory %s for output audio files." % mezzanine)
+        except OSError:
+            print("Sorry, the directory %s is weird. Might be a file?" % mezzanine)
+            exit(1)
+        # Index the hashes already in the mezzanine directory before any work starts
+        ingest.mezzanineIndex(mezzanine)
+    else:
+        mezzanine = None
 
+    print("Working on playlist: %s" % playlist)
+    print("Looking for levels of %f LU below average loudness" % level)
+    print("Writing to %s" % outfile)
+    if candidatesFile:
+        print("Writing cue points for %s combinations of levels to %s" % (len(thresholds), candidatesFile))
 
+    with open(playlist) as i:
+        playlistLines = i.readlines()
 
+    print("We have read %s items." % len(playlistLines))
+
+    # Every finished track is recorded in the journal as soon as it is done. After a crash,
+    # --resume skips those tracks and rebuilds the output playlist from their recorded results.
+    journal = ingest.Journal(outfile + ".journal", resume=args.resume)
+
+    if args.timings:
+        ingest.startTimings(args.timings)
+
+    print("Processing %s tracks at once." % args.jobs)
+
+    # Skip the M3U indicator
+    playlistItems = [item for item in playlistLines if item != "#EXTM3U\n"]
+
+    # Tracks are handed to a pool of workers. The heavy lifting is done by FFmpeg child processes,
+    # so threads are enough to keep the cores busy. Results are collected in playlist order, so the
+    # output playlist keeps the order of the input whatever order the tracks finish in.
+    # The mezzanine files of tracks already in the journal are theirs, so no other track may adopt them.
+    if mezzanine:
+        for index, item in enumerate(playlistItems):
+            if journal.completed(index, item.strip()) and journal.result(index) and journal.result(index)["mezzanine_name"]:
+                name = journal.result(index)["mezzanine_name"]
+                ingest.mezzanineIndex(mezzanine).adopt(re.search(MD5HashRE, os.path.basename(name)).group(0), name)
+
+    # Tracks claim their audio in playlist order. One that fails before its turn comes has the turn
+    # passed for it here, and those already in the journal have had theirs, so no track waits for ever.
+    def analyseInTurn(order, **kwargs):
+        try:
+            return(analyse(order=order, **kwargs))
+        finally:
+            if mezzanine:
+                ingest.mezzanineIndex(mezzanine).passTurn(order)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor, open(outfile, mode="w") as out:
+        futures = []
+        for index, item in enumerate(playlistItems):
+            if journal.completed(index, item.strip()):
+                if mezzanine:
+                    ingest.mezzanineIndex(mezzanine).passTurn(index)
+                futures.append(None)
+            else:
+                futures.append(executor.submit(journal.run, index, item.strip(), analyseInTurn, order=index, filename=item.strip(), volDrop=level, volStart=cue, \
+                        mezzanine=mezzanine, forceEncode=False, singlePass=args.single_pass, tryLevels=thresholds[1:], \
+                        seriesCache=args.series_cache, hashCacheFile=args.hash_cache, fastHash=args.fast_hash, hashMapFile=args.hash_map, engine=args.engine, \
+                        windowed=(args.head, args.tail) if args.windowed else None, trustTags=args.trust_tags, adopt=args.resume))
+        out.write("#EXTM3U\n")
+        if candidatesFile:
+            candidatesOut = open(candidatesFile, mode="w", newline='')
+            candidatesWriter = csv.writer(candidatesOut)
+            candidatesWriter.writerow(["filename", "level", "cue", "cue_point", "start_next", "longtail"])
+
+        for index, (item, future) in enumerate(zip(playlistItems, futures)):
+            try:
+                result = journal.result(index) if future is None else future.result()
+            except BaseException:
+                # Don't start any more tracks once one has failed
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            # analyse() returns None if the audio has already been converted.
+            # At this point, we can skip writing a new line to the playlist, because the file is already
+            # extant, and must have been referenced already within the playlist we're creating.
+            if result==None:
+                continue
+            if result["mezzanine_name"]:
+                # Remember, a file read in lines has a newline on the end of every line
+                item = result["mezzanine_name"] + '\n'
+
+            assembly = playlistLine(result, item, ceiling=args.true_peak_ceiling)
+            print("Writing line:")
+            print(assembly)
+            out.write(assembly)
+            if candidatesFile:
+                for candidate in result["candidates"]:
+                    candidatesWriter.writerow([item.strip(), candidate["volDrop"], candidate["volStart"], \
+                            '{:.3f}'.format(candidate["cue_point"]), '{:.3f}'.format(candidate["start_next"]), candidate["longtail"]])
+            # Fingerprinting is now in a separate program
+            #fing = fingerprint(item.strip())
+            #fd = open('database.csv', 'a')
+            #csvWriter = csv.writer(fd)
+            #csvWriter.writerow([item.strip(), fing])
+            #fd.close()
+            #print("Fingerprint is:")
+            #print(fing)
+        if candidatesFile:
+            candidatesOut.close()
+    journal.finish()
+    ingest.finishTimings()
+    print("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,14 +10,36 @@
 ###
 ### Uses parallel processing. Redirect output to get a list for working on.
 ###
+### Only pairs of tracks whose fingerprints share some sub-fingerprints are
+### compared in full, as found by an inverted index (see fingerprints.py).
+### --brute-force compares every pair, as before, and --recall-sample checks
+### on a sample of tracks that the index misses none of the matches found
+### by comparing them with every other track.
+###
+### Pairs are scored by the share of fingerprint bits that differ, one track
+### against a block of others at a time, and the bit error rate mapped onto
+### the 0-100 scale fuzz.ratio used to give. --fuzz scores with fuzz.ratio
+### on the text of the fingerprints, as before.
+###
+### Tracks are sorted by duration, and only pairs within --max-duration-diff
+### seconds of each other are ever generated or scored.
+###
+### With --incremental, only tracks that are new, or whose fingerprints have
+### changed, since the last --incremental run are compared: with each other
+### and with the rest. Their matches are merged into the existing output file.
+###
+### With --shard i/n, only the i-th of n shares of the work is done, so that
+### several machines can share it. Each writes its matches and a manifest;
+### --merge checks that the manifests cover all the work, and combines them.
+###
 
 
-import itertools
-from rapidfuzz import fuzz
 from multiprocessing import Pool
 from multiprocessing import cpu_count
 import argparse
-import csv, sys
+import csv, hashlib, json, os, random, sys
+import numpy as np
+import fingerprints
 
 CPUCOUNT = cpu_count()
 
@@ -26,73 +48,320 @@ parser.add_argument('-i', '--input', default='chromaprints.csv',
         help='Specify input CSV file containing chromaprints to be compared. Default: %(default)s')
 parser.add_argument('-o', '--output', default='duplicates.csv',
         help='Specify output CSV file containing possible duplicates. Default: %(default)s')
+parser.add_argument('-s', '--store',
+        help='Read the fingerprints from this binary fingerprint store (made by chromaprint_db.py --store) instead of the input CSV file')
 parser.add_argument('-m', '--match', default=70, type=int,
         help='Integer specifying match factor required for duplicate detection. Default: %(default)i')
+parser.add_argument('--brute-force', action='store_true',
+        help='Compare every pair of tracks, instead of only those sharing sub-fingerprints')
+parser.add_argument('--min-shared', default=3, type=int,
+        help='Sub-fingerprints two tracks must share to be compared in full. Default: %(default)i')
+parser.add_argument('--max-posting', default=100, type=int,
+        help='Ignore sub-fingerprints found in more than this many tracks, such as silence. Default: %(default)i')
+parser.add_argument('--recall-sample', default=0, type=int,
+        help='Afterwards, compare this many randomly chosen tracks with every other track, and report '
+             'any matches that were missed. Default: %(default)i')
+parser.add_argument('--seed', default=1, type=int,
+        help='Seed for choosing the recall sample. Default: %(default)i')
+parser.add_argument('--max-offset', default=0, type=int,
+        help='Largest misalignment of two fingerprints looked for, in words of about 0.12s. Each step either way '
+             'is another full comparison, so 4 is about nine times slower. Default: %(default)i')
+parser.add_argument('--max-duration-diff', default=120.0, type=float,
+        help='Only compare tracks whose durations are within this many seconds of each other. Default: %(default)s')
+parser.add_argument('--fuzz', action='store_true',
+        help='Score pairs with fuzz.ratio on the text of the fingerprints, as older versions did. Much slower')
+parser.add_argument('--incremental', action='store_true',
+        help='Only compare tracks fingerprinted since the last --incremental run, and merge their matches into the output file')
+parser.add_argument('--state',
+        help='File recording which fingerprints have been compared, for --incremental. Default: \'-compared.json\' suffix on the output file')
+parser.add_argument('--shard',
+        help='Do only share i of n of the work, from 1/n to n/n, writing the matches and a manifest '
+             'beside the output file with a \'-shard-i-of-n\' suffix')
+parser.add_argument('--merge', nargs='+', metavar='MANIFEST',
+        help='Check that these shard manifests cover all the work, and combine their matches into the output file')
 
 args = parser.parse_args()
 
+if args.shard:
+    try:
+        SHARD, SHARDS = (int(number) for number in args.shard.split('/'))
+    except ValueError:
+        parser.error("--shard must be written as i/n, for example 2/4")
+    if not 1 <= SHARD <= SHARDS:
+        parser.error("--shard i/n needs i from 1 to n")
+    if args.incremental or args.recall_sample:
+        parser.error("--shard can't be used with --incremental or --recall-sample")
+
+if args.fuzz:
+    from rapidfuzz import fuzz
+
 # This is the filename of the .csv containing the chromaprints to compare
 FILENAME = args.input
 OUTPUT = args.output
 MATCH = args.match
+STATE = args.state or os.path.splitext(OUTPUT)[0] + "-compared.json"
+# An incremental run can only add to results found with the same settings
+SETTINGS = {setting: getattr(args, setting) for setting in
+            ('match', 'brute_force', 'min_shared', 'max_posting', 'max_offset', 'max_duration_diff', 'fuzz')}
 
-class csvTextBuilder(object):
-    def __init__(self):
-        self.csv_string = []
 
-    def write(self,row):
-        self.csv_string.append(row)
 
+def merge_shards(manifests):
+    # Returns 0 if the manifests are one of each shard of the same work, and their
+    # matches have been combined into the output file
+    records = []
+    for manifest in manifests:
+        with open(manifest, encoding='utf-8') as manifestfile:
+            record = json.load(manifestfile)
+        record['results'] = os.path.join(os.path.dirname(manifest), record['results'])
+        records.append(record)
+    problems = []
+    for key in ('input', 'settings', 'shards', 'total_pairs'):
+        if any(record[key] != records[0][key] for record in records):
+            problems.append("The shards disagree about %s: they aren't from the same run." % key)
+    shards = sorted(record['shard'] for record in records)
+    if shards != list(range(1, records[0]['shards'] + 1)):
+        problems.append("Expected shards 1 to %s once each, found %s." % (records[0]['shards'], shards))
+    if sum(record['pairs'] for record in records) != records[0]['total_pairs']:
+        problems.append("The shards didn't compare every pair between them.")
+    for record in records:
+        if not os.path.exists(record['results']):
+            problems.append("%s is missing." % record['results'])
+            continue
+        with open(record['results'], 'rb') as results:
+            if hashlib.md5(results.read()).hexdigest() != record['md5']:
+                problems.append("%s has changed since its shard finished." % record['results'])
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    if problems:
+        return(1)
+    with open(OUTPUT + '.part', 'w', newline='') as f:
+        for record in sorted(records, key=lambda record: record['shard']):
+            with open(record['results'], newline='') as results:
+                f.write(results.read())
+    os.replace(OUTPUT + '.part', OUTPUT)
+    print("Merged %s shards, %s combinations, %s matches, into %s." % (len(records), records[0]['total_pairs'],
+          sum(record['rows'] for record in records), OUTPUT), file=sys.stderr)
+    return(0)
 
-with open(FILENAME) as csvfile:
-    DATA = list(csv.reader(csvfile))
+
+if args.merge:
+    sys.exit(merge_shards(args.merge))
+
+# WORDS holds each fingerprint as words, as far as chromaprints.csv would keep it. The store
+# holds them already, so its fingerprints are only turned into text when --fuzz needs it.
+if args.store:
+    store = fingerprints.FingerprintStore(args.store)
+    if args.fuzz:
+        DATA = list(store.legacyRows())
+    else:
+        DATA = [[filename, None, duration] for filename, duration in zip(store.filenames, store.durations)]
+    WORDS = [store.fingerprint(track)[:fingerprints.LEGACY_WORDS] for track in range(0, len(DATA))]
+else:
+    with open(FILENAME) as csvfile:
+        DATA = list(csv.reader(csvfile))
+    WORDS = [fingerprints.parseLegacy(row[1]) for row in DATA]
 
 DATALENGTH = len(DATA)
 
+# Sorted by duration, the tracks close enough in length to match a track are a run of its
+# neighbours. POSITION keeps where each was in the input, so that pairs are written in the
+# same order as before.
+POSITION = sorted(range(0, DATALENGTH), key=lambda track: float(DATA[track][2]))
+DATA = [DATA[track] for track in POSITION]
+WORDS = [WORDS[track] for track in POSITION]
+DURATIONS = np.array([float(row[2]) for row in DATA])
+WINDOW_START = np.searchsorted(DURATIONS, DURATIONS - args.max_duration_diff, side='left')
+WINDOW_END = np.searchsorted(DURATIONS, DURATIONS + args.max_duration_diff, side='right')
+
+# NEW marks the tracks to be compared: all of them, unless an earlier incremental run with the
+# same settings compared the same fingerprint under the same filename.
+DIGESTS = [hashlib.md5(np.asarray(words, dtype='<u4').tobytes()).hexdigest() for words in WORDS]
+COMPARED = {}
+if args.incremental and os.path.exists(STATE) and os.path.exists(OUTPUT):
+    with open(STATE, encoding='utf-8') as statefile:
+        state = json.load(statefile)
+    if state['settings'] == SETTINGS:
+        COMPARED = state['compared']
+    else:
+        print("Settings have changed since the last run, so every track will be compared.", file=sys.stderr)
+NEW = np.array([COMPARED.get(row[0]) != digest for row, digest in zip(DATA, DIGESTS)], dtype=bool)
+
 print("We will use %s processes." % CPUCOUNT, file=sys.stderr)
 print("We have read %s lines." % DATALENGTH, file=sys.stderr)
+if args.incremental:
+    print("%s tracks are new or changed since the last run." % NEW.sum(), file=sys.stderr)
 print("Starting to make list of combinations...", file=sys.stderr)
-combos = list(itertools.combinations(range(0, DATALENGTH), 2))
-print("There are %s combinations to explore." % len(combos), file=sys.stderr)
+# The fingerprints, and the candidate pairs, are globals: worker processes inherit them once
+# when the Pool starts, and are only ever sent the bounds of the tiles they are to compare.
+MATRIX, LENGTHS = fingerprints.fingerprintMatrix(WORDS)
+del WORDS
+if args.brute_force:
+    # A new track is compared with every later track in its window, and every earlier old one
+    OLD_BEFORE = np.concatenate(([0], np.cumsum(~NEW)))
+    combinationCount = int(((WINDOW_END - np.arange(1, DATALENGTH + 1)).clip(0) +
+                            OLD_BEFORE[np.arange(DATALENGTH)] - OLD_BEFORE[WINDOW_START])[NEW].sum())
+else:
+    pairs = fingerprints.candidatePairs([MATRIX[track, :LENGTHS[track]] for track in range(0, DATALENGTH)],
+                                        args.min_shared, args.max_posting)
+    pairs = pairs[(pairs[:, 1] < WINDOW_END[pairs[:, 0]]) & (NEW[pairs[:, 0]] | NEW[pairs[:, 1]])]
+    combinationCount = len(pairs)
+print("There are %s combinations to explore." % combinationCount, file=sys.stderr)
 print("*** DATABASE", file=sys.stderr)
 
+# A tile of the comparison matrix is TILE_ROWS tracks, each against up to TILE_COLUMNS later
+# tracks; or, from the candidate pairs, PAIR_TILE of them.
+TILE_ROWS = 256
+TILE_COLUMNS = 4096
+PAIR_TILE = 65536
 
-def checkcombo(tracklistCombos):
-    # print("Matching: ", tracklistCombos)
-    match = fuzz.ratio(DATA[tracklistCombos[0]][1], DATA[tracklistCombos[1]][1])
-#    if (match >= 50):
-        #print("We're matching %s with %s." % (DATA[tracklistCombos[0]][1], DATA[tracklistCombos[1]][1]))
-        #print("Closeness of %s is %s" % (tracklistCombos, match))
-        #print("This represents:")
-        #print(DATA[tracklistCombos[0]][0])
-        #print("and")
-        #print(DATA[tracklistCombos[1]][0])i
-        #print("%s, %s, %s" % (match, DATA[tracklistCombos[0]][0], DATA[tracklistCombos[1]][0]))
-#        print('%s, "%s", "%s"' % (match, DATA[tracklistCombos[0]][0].replace('"', '""'), DATA[tracklistCombos[1]][0].replace('"', '""')))
-    if (match >= MATCH):
-        # Check durations. Are the tracks within 120s of each other?
-        difference = abs(float(DATA[tracklistCombos[0]][2]) - float(DATA[tracklistCombos[1]][2]))
-        print("Match found: difference is %s" % difference, file=sys.stderr)
-        if difference <= 120:
-            csvdata = [match, DATA[tracklistCombos[0]][0], DATA[tracklistCombos[1]][0]]
-            csvfile = csvTextBuilder()
-            csvwriter = csv.writer(csvfile)
-            csvwriter.writerow(csvdata)
-            csvString = csvfile.csv_string
-            return(''.join(csvString))
-
-#            return('%s, "%s", "%s"\n' % (match, DATA[tracklistCombos[0]][0].replace('"', '""'), DATA[tracklistCombos[1]][0].replace('"', '""')))
-        else:
-            return("")
+
+def tiles():
+    # Made as the pool asks for them, in order of the duration-sorted tracks
+    if args.brute_force:
+        for rowStart in range(0, DATALENGTH, TILE_ROWS):
+            rowEnd = min(rowStart + TILE_ROWS, DATALENGTH)
+            if not NEW[rowStart:rowEnd].any():
+                continue
+            # The last row's window reaches furthest, as the tracks are sorted by duration. Old
+            # tracks before the rows are only compared in an incremental run.
+            columnEnd = int(WINDOW_END[rowEnd - 1])
+            firstColumn = int(WINDOW_START[rowStart]) if not NEW.all() else rowStart + 1
+            for columnStart in range(firstColumn, columnEnd, TILE_COLUMNS):
+                yield (rowStart, rowEnd, columnStart, min(columnStart + TILE_COLUMNS, columnEnd))
+    else:
+        for pairStart in range(0, len(pairs), PAIR_TILE):
+            yield (pairStart, min(pairStart + PAIR_TILE, len(pairs)))
+
+
+def shardTiles():
+    # This shard's share of the tiles: a run of them holding about 1/n of the pairs. Brute-force
+    # tiles are divided whole, and candidate pairs are divided before they are cut into tiles.
+    if args.brute_force:
+        allTiles = list(tiles())
+        sizes = np.array([tileSize(tile) for tile in allTiles], dtype=np.int64)
+        middles = np.cumsum(sizes) - sizes / 2
+        owners = np.minimum((middles * SHARDS / max(sizes.sum(), 1)).astype(int), SHARDS - 1)
+        return([tile for tile, owner in zip(allTiles, owners) if owner == SHARD - 1])
+    low = (SHARD - 1) * len(pairs) // SHARDS
+    high = SHARD * len(pairs) // SHARDS
+    return([(pairStart, min(pairStart + PAIR_TILE, high)) for pairStart in range(low, high, PAIR_TILE)])
+
+
+def tileSize(tile):
+    # The number of pairs in a brute-force tile, for a run comparing every track
+    rowStart, rowEnd, columnStart, columnEnd = tile
+    rows = np.arange(rowStart, rowEnd)
+    return(int((np.minimum(columnEnd, WINDOW_END[rows]) - np.maximum(columnStart, rows + 1)).clip(0).sum()))
+
+
+def matches(track, others):
+    # The tracks among others that match track closely enough, and their scores
+    if args.fuzz:
+        scores = np.array([fuzz.ratio(DATA[track][1], DATA[other][1]) for other in others])
+    else:
+        scores = np.round(fingerprints.matchScore(fingerprints.bitErrorRates(MATRIX, LENGTHS, track, others, args.max_offset))).astype(int)
+    found = []
+    for index in np.flatnonzero(scores >= MATCH):
+        other = int(others[index])
+        print("Match found: difference is %s" % abs(DURATIONS[track] - DURATIONS[other]), file=sys.stderr)
+        found.append((other, scores[index].item()))
+    return(found)
+
+
+def checktile(tile):
+    # Returns the number of pairs compared, and only the matches in the tile, as (match, track, other)
+    hits = []
+    scored = 0
+    if args.brute_force:
+        rowStart, rowEnd, columnStart, columnEnd = tile
+        for track in np.flatnonzero(NEW[rowStart:rowEnd]) + rowStart:
+            others = np.arange(max(columnStart, WINDOW_START[track]), min(columnEnd, WINDOW_END[track]))
+            # Each pair once: a later track, or an earlier one that isn't being compared itself
+            others = others[(others > track) | ~NEW[others]]
+            scored += len(others)
+            if len(others):
+                hits += [(match, int(track), other) for other, match in matches(track, others)]
     else:
-        return("")
+        tilePairs = pairs[tile[0]:tile[1]]
+        scored = len(tilePairs)
+        if args.fuzz:
+            tracks, starts = np.unique(tilePairs[:, 0], return_index=True)
+            for track, others in zip(tracks.tolist(), np.split(tilePairs[:, 1], starts[1:])):
+                hits += [(match, track, other) for other, match in matches(track, others)]
+        else:
+            # A track has only a few candidates, so the whole tile is scored at once rather than
+            # track by track, which would spend its time in NumPy's overhead for each call
+            scores = np.round(fingerprints.matchScore(fingerprints.pairErrorRates(MATRIX, LENGTHS, tilePairs, args.max_offset))).astype(int)
+            for index in np.flatnonzero(scores >= MATCH):
+                track, other = int(tilePairs[index, 0]), int(tilePairs[index, 1])
+                print("Match found: difference is %s" % abs(DURATIONS[track] - DURATIONS[other]), file=sys.stderr)
+                hits.append((scores[index].item(), track, other))
+    return((scored, hits))
+
+
+def recall_check(p):
+    # Brute force for a sample of tracks: every match it finds should be among the combinations
+    candidates = np.flatnonzero(NEW).tolist()
+    sample = random.Random(args.seed).sample(candidates, min(args.recall_sample, len(candidates)))
+    sampleBlocks = [(track, np.delete(np.arange(WINDOW_START[track], WINDOW_END[track]), track - WINDOW_START[track])) for track in sample]
+    print("Recall check: comparing %s tracks with every other track, %s combinations." % (len(sample), sum(len(others) for _, others in sampleBlocks)), file=sys.stderr)
+    found = set()
+    for (track, _), results in zip(sampleBlocks, p.starmap(matches, sampleBlocks)):
+        found.update((min(track, other), max(track, other)) for other, _ in results)
+    explored = set(map(tuple, pairs.tolist()))
+    missed = sorted(pair for pair in found if pair not in explored)
+    print("Recall check: %s of %s matches found." % (len(found) - len(missed), len(found)), file=sys.stderr)
+    for pair in missed:
+        print("Missed: %s, %s" % (DATA[pair[0]][0], DATA[pair[1]][0]), file=sys.stderr)
 
 
 def pool_handler():
     p = Pool(CPUCOUNT)
-    with open(OUTPUT, 'w') as f:
-        for result in p.imap(checkcombo, combos, 250):
-            f.write(result)
+    results = OUTPUT
+    work = tiles()
+    if args.shard:
+        results = '%s-shard-%d-of-%d.csv' % (os.path.splitext(OUTPUT)[0], SHARD, SHARDS)
+        work = shardTiles()
+    scored = 0
+    rows = 0
+    with open(results + '.part', 'w', newline='') as f:
+        csvwriter = csv.writer(f)
+        if COMPARED:
+            # Keep the earlier matches between tracks that haven't changed
+            unchanged = set(row[0] for row, new in zip(DATA, NEW) if not new)
+            with open(OUTPUT, newline='') as previous:
+                kept = [row for row in csv.reader(previous) if row[1] in unchanged and row[2] in unchanged]
+            csvwriter.writerows(kept)
+            print("Kept %s matches from the last run." % len(kept), file=sys.stderr)
+        for tileScored, hits in p.imap(checktile, work):
+            scored += tileScored
+            rows += len(hits)
+            for match, track, other in hits:
+                first, second = sorted((track, other), key=lambda index: POSITION[index])
+                csvwriter.writerow([match, DATA[first][0], DATA[second][0]])
+    os.replace(results + '.part', results)
+    print("Compared %s combinations." % scored, file=sys.stderr)
+    if args.shard:
+        # The manifest is written last: a shard without one didn't finish
+        with open(results, 'rb') as resultsfile:
+            digest = hashlib.md5(resultsfile.read()).hexdigest()
+        inputDigest = hashlib.md5('\n'.join('%s,%s,%s' % (row[0], fingerprint, row[2])
+                                            for row, fingerprint in zip(DATA, DIGESTS)).encode('utf-8')).hexdigest()
+        manifest = os.path.splitext(results)[0] + '.json'
+        with open(manifest + '.part', 'w', encoding='utf-8') as manifestfile:
+            json.dump({'shard': SHARD, 'shards': SHARDS, 'input': inputDigest, 'settings': SETTINGS,
+                       'pairs': scored, 'total_pairs': combinationCount,
+                       'results': os.path.basename(results), 'md5': digest, 'rows': rows}, manifestfile, indent=1)
+        os.replace(manifest + '.part', manifest)
+        print("Shard %s of %s written to %s, with manifest %s." % (SHARD, SHARDS, results, manifest), file=sys.stderr)
+    if args.incremental:
+        with open(STATE + '.part', 'w', encoding='utf-8') as statefile:
+            json.dump({'settings': SETTINGS, 'compared': dict((row[0], digest) for row, digest in zip(DATA, DIGESTS))},
+                      statefile, ensure_ascii=False)
+        os.replace(STATE + '.part', STATE)
+    if args.recall_sample > 0 and not args.brute_force:
+        recall_check(p)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,449 @@
+#!/usr/bin/python3
+# This is a MODULE
+#
+# A compact store for the Chromaprint fingerprints made by chromaprint_db.py.
+#
+# chromaprints.csv holds each 32-bit fingerprint word as 16 base-4 digits, so every
+# fingerprint is about 3KB of text that has to be parsed again whenever it is read.
+# The store keeps the words themselves, packed, and can be mapped straight into memory.
+# Also here: the state that lets chromaprint_db.py rescan a library incrementally.
+
+import csv
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import ingest
+
+# chromaprints.csv keeps only the first 3059 characters of each fingerprint: 180 words of
+# 16 digits, with a comma between each.
+LEGACY_LENGTH = 3059
+LEGACY_WORDS = (LEGACY_LENGTH + 1) // 17
+
+_DIGITS = np.array(list("0123"))
+_SHIFTS = np.arange(30, -1, -2, dtype=np.uint32)
+
+
+def legacyString(words: Sequence[int]) -> str:
+    """A fingerprint as chromaprints.csv holds it: base-4 words, comma separated, truncated."""
+    words = np.asarray(words[:LEGACY_WORDS], dtype=np.uint32)
+    digits = _DIGITS[(words[:, np.newaxis] >> _SHIFTS) & 3]
+    return ",".join("".join(row) for row in digits)
+
+
+class FingerprintStore(object):
+    """
+    Fingerprints as packed little-endian uint32 words, in a directory holding:
+
+      words.u32   the words of every fingerprint, one fingerprint after another
+      index.csv   filename, duration, offset and count of each (in words)
+
+    Both files are only ever appended to. The words are written before their index
+    row, so an interrupted run can leave unused words at the end of words.u32, but
+    never an index row without its words. Appending is for one writer at a time.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.wordsPath = os.path.join(directory, "words.u32")
+        self.indexPath = os.path.join(directory, "index.csv")
+        os.makedirs(directory, exist_ok=True)
+        self.filenames: List[str] = []
+        self.durations: List[float] = []
+        self.offsets: List[int] = []
+        self.counts: List[int] = []
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath, newline="", encoding="utf-8") as f:
+                for row in csv.reader(f):
+                    if len(row) != 4:
+                        continue
+                    self.filenames.append(row[0])
+                    self.durations.append(float(row[1]))
+                    self.offsets.append(int(row[2]))
+                    self.counts.append(int(row[3]))
+        self.known = set(self.filenames)
+        self._words: Optional[np.ndarray] = None
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.known
+
+    def append(self, filename: str, words: Sequence[int], duration: float) -> None:
+        """Add a fingerprint. It is on disk when this returns."""
+        packed = np.asarray(words, dtype="<u4")
+        with open(self.wordsPath, "ab") as f:
+            offset = f.tell() // 4
+            f.write(packed.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.indexPath, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow([filename, duration, offset, len(packed)])
+            f.flush()
+            os.fsync(f.fileno())
+        self.filenames.append(filename)
+        self.durations.append(float(duration))
+        self.offsets.append(offset)
+        self.counts.append(len(packed))
+        self.known.add(filename)
+        self._words = None
+
+    def words(self) -> np.ndarray:
+        """Every word in the store, mapped read-only from disk."""
+        if self._words is None:
+            if os.path.exists(self.wordsPath) and os.path.getsize(self.wordsPath) >= 4:
+                self._words = np.memmap(self.wordsPath, dtype="<u4", mode="r")
+            else:
+                self._words = np.zeros(0, dtype="<u4")
+        return self._words
+
+    def fingerprint(self, index: int) -> np.ndarray:
+        """The words of the index'th fingerprint."""
+        offset = self.offsets[index]
+        return self.words()[offset:offset + self.counts[index]]
+
+    def legacyRows(self):
+        """Rows in the form of chromaprints.csv: filename, fingerprint string, duration."""
+        for index, filename in enumerate(self.filenames):
+            duration = self.durations[index]
+            yield [filename, legacyString(self.fingerprint(index)), int(duration) if duration.is_integer() else duration]
+
+    def exportCSV(self, path: str) -> int:
+        """Write the whole store as a chromaprints.csv file. Returns the number of rows."""
+        with open(path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            count = 0
+            for row in self.legacyRows():
+                writer.writerow(row)
+                count += 1
+        return count
+
+    def importCSV(self, path: str) -> int:
+        """Add the fingerprints in a chromaprints.csv file that aren't in the store yet."""
+        count = 0
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.reader(f):
+                if len(row) < 3 or row[0] in self:
+                    continue
+                words = [int(word, 4) for word in row[1].split(",") if len(word) == 16]
+                self.append(row[0], words, float(row[2]))
+                count += 1
+        return count
+
+
+    def link(self, filename: str, newFilename: str) -> None:
+        """Add newFilename as another name for the fingerprint of filename, sharing its words."""
+        index = self.filenames.index(filename)
+        with open(self.indexPath, "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerow([newFilename, self.durations[index], self.offsets[index], self.counts[index]])
+            f.flush()
+            os.fsync(f.fileno())
+        self.filenames.append(newFilename)
+        self.durations.append(self.durations[index])
+        self.offsets.append(self.offsets[index])
+        self.counts.append(self.counts[index])
+        self.known.add(newFilename)
+
+    def remove(self, filenames, before: Optional[int] = None) -> None:
+        """
+        Drop these filenames from the index, which is rewritten under a temporary
+        name and renamed into place. Their words stay in words.u32. If before is
+        given, only entries before that position go, so a name linked again since
+        then keeps its new entry.
+        """
+        filenames = set(filenames)
+        before = len(self.filenames) if before is None else before
+        keep = [i for i, filename in enumerate(self.filenames) if filename not in filenames or i >= before]
+        temporaryFile = self.indexPath + ".part"
+        with open(temporaryFile, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            for i in keep:
+                writer.writerow([self.filenames[i], self.durations[i], self.offsets[i], self.counts[i]])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporaryFile, self.indexPath)
+        self.filenames = [self.filenames[i] for i in keep]
+        self.durations = [self.durations[i] for i in keep]
+        self.offsets = [self.offsets[i] for i in keep]
+        self.counts = [self.counts[i] for i in keep]
+        self.known = set(self.filenames)
+
+
+# --- Incremental library scan ---
+#
+# A nightly rescan of the whole library shouldn't fingerprint it all again. Each fingerprinted
+# file's size, mtime and audio hash are kept in a scan state, as JSON lines, so that a file that
+# hasn't changed is recognised from its stat() alone, a re-tagged file by its unchanged audio,
+# and a moved or renamed file by finding its audio hash under another name.
+
+def scanTree(root: str, suffix: str = ".mka") -> Dict[str, Tuple[int, int]]:
+    """Every file under root ending with suffix, mapped to its (size, mtime_ns)."""
+    found = {}
+    folders = [root]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif entry.name.endswith(suffix) and entry.is_file():
+                            st = entry.stat()
+                            found[os.path.normpath(entry.path)] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        continue
+        except OSError as e:
+            print("Warning: could not scan '%s': %s" % (folder, e), file=sys.stderr)
+    return found
+
+
+def underRoot(root: str, filename: str) -> bool:
+    """Whether filename, as a path like those scanTree(root) returns, lies under root."""
+    root = os.path.normpath(root)
+    filename = os.path.normpath(filename)
+    if root == ".":
+        return not os.path.isabs(filename) and not filename.startswith("..")
+    return filename.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def audioHash(filename: str) -> str:
+    """
+    The identity of the audio in filename: the MD5 in a mezzanine filename, or
+    else the hash of its compressed packets, which re-tagging doesn't change.
+    """
+    found = ingest.MD5HashRE.search(os.path.basename(filename))
+    if found:
+        return found.group(0).lower()
+    return ingest.packetHash(filename)
+
+
+class ScanState(object):
+    """
+    Persistent map from a fingerprinted path to its (size, mtime_ns, audio hash),
+    kept as JSON lines. The last line for a path wins; a path that has gone is
+    recorded as removed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files: Dict[str, Tuple[int, int, str]] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        if rec.get("removed"):
+                            self.files.pop(rec["path"], None)
+                        else:
+                            self.files[rec["path"]] = (rec["size"], rec["mtime_ns"], rec["hash"])
+                    except (ValueError, KeyError):
+                        # A line cut short by an interrupted run
+                        continue
+
+    def get(self, filename: str) -> Optional[Tuple[int, int, str]]:
+        return self.files.get(filename)
+
+    def _write(self, rec: Dict) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def put(self, filename: str, size: int, mtime: int, hashout: str) -> None:
+        self.files[filename] = (size, mtime, hashout)
+        self._write({"path": filename, "size": size, "mtime_ns": mtime, "hash": hashout})
+
+    def remove(self, filename: str) -> None:
+        if self.files.pop(filename, None) is not None:
+            self._write({"path": filename, "removed": True})
+
+    def compact(self) -> None:
+        """Rewrite the state with one line per path, under a temporary name renamed into place."""
+        temporaryFile = self.path + ".part"
+        with open(temporaryFile, "w", encoding="utf-8") as f:
+            for filename, (size, mtime, hashout) in self.files.items():
+                f.write(json.dumps({"path": filename, "size": size, "mtime_ns": mtime, "hash": hashout},
+                                   ensure_ascii=False) + "\n")
+        os.replace(temporaryFile, self.path)
+
+
+# --- Candidate pairs for de-duplication ---
+#
+# Scoring every pair of N fingerprints is N(N-1)/2 comparisons. Instead, each fingerprint is
+# cut into sub-fingerprint keys, and an inverted index from key to fingerprints finds the pairs
+# that share enough keys to be worth scoring in full. The keys are each 32-bit word, and the
+# 16-bit halves of each word tagged with where in the fingerprint it falls, to within a few
+# words, so that words differing in a quarter of their bits can still meet through a half
+# they agree on. Keys shared by very many fingerprints, such as those of silence, say nothing
+# about a pair and are left out.
+
+# Words in each stretch of fingerprint that half-word keys are tagged with
+KEY_STRETCH = 8
+# Pairs counted at once: about 8 bytes each, several times over while counting
+PAIR_BATCH = 20000000
+
+
+def parseLegacy(text: str) -> np.ndarray:
+    """The words of a fingerprint from chromaprints.csv, where each is 16 base-4 digits."""
+    words = [word for word in text.split(",") if len(word) == 16]
+    if not words:
+        return np.zeros(0, dtype=np.uint32)
+    digits = np.frombuffer("".join(words).encode("ascii"), dtype=np.uint8).reshape(-1, 16) - ord("0")
+    return (digits.astype(np.uint32) << _SHIFTS).sum(axis=1, dtype=np.uint32)
+
+
+def subFingerprintKeys(words: np.ndarray) -> np.ndarray:
+    """The distinct sub-fingerprint keys of a fingerprint, as int64, tagged by the kind of key."""
+    words = np.asarray(words, dtype=np.int64)
+    stretch = (np.arange(len(words)) // KEY_STRETCH) << 17
+    keys = np.concatenate((words, (1 << 40) | stretch | (words >> 16), (1 << 40) | stretch | (1 << 16) | (words & 0xFFFF)))
+    return np.unique(keys)
+
+
+def candidatePairs(fingerprints: Sequence[np.ndarray], minShared: int = 3, maxPosting: int = 100) -> np.ndarray:
+    """
+    Pairs (i, j), i < j, of fingerprints sharing at least minShared keys, counting only
+    keys found in no more than maxPosting fingerprints. Returns a K x 2 int64 array.
+    """
+    count = len(fingerprints)
+    keyLists = [subFingerprintKeys(words) for words in fingerprints]
+    tracks = np.repeat(np.arange(count, dtype=np.int32), [len(k) for k in keyLists])
+    keys = np.concatenate(keyLists) if keyLists else np.zeros(0, dtype=np.int64)
+    del keyLists
+    # A stable sort keeps each key's fingerprints in ascending order
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    tracks = tracks[order]
+    del order
+
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    sizes = np.diff(np.concatenate((starts, [len(keys)])))
+    del keys
+    useful = (sizes >= 2) & (sizes <= maxPosting)
+    groups = [tracks[starts[useful & (sizes == size)][:, np.newaxis] + np.arange(size)].astype(np.int64)
+              for size in np.unique(sizes[useful])]
+    del tracks, starts, sizes, useful
+
+    # Every pair in every posting list is counted, as i * count + j. Where there are too many
+    # to count at once, they are counted for one range of i at a time.
+    total = int(sum(len(group) * group.shape[1] * (group.shape[1] - 1) // 2 for group in groups))
+    passes = -(-total // PAIR_BATCH)
+    found = [np.zeros(0, dtype=np.int64)]
+    for part in range(passes):
+        low = part * count // passes
+        high = (part + 1) * count // passes
+        codes = []
+        for group in groups:
+            for column in range(group.shape[1] - 1):
+                rows = group[(group[:, column] >= low) & (group[:, column] < high)]
+                codes.append((rows[:, column, np.newaxis] * count + rows[:, column + 1:]).ravel())
+        pairs, shared = np.unique(np.concatenate(codes), return_counts=True)
+        found.append(pairs[shared >= minShared])
+    pairs = np.concatenate(found)
+    return np.stack((pairs // count, pairs % count), axis=1)
+
+
+# --- Bit error rate ---
+#
+# Chromaprint fingerprints are compared by the share of their bits that differ, word by
+# word, at the alignment where they agree best. fuzz.ratio on the base-4 text measured
+# something only loosely related, but dedup.py's --match is on its scale, so bit error
+# rates are mapped onto it. The mapping was measured on random 180-word fingerprints,
+# with bits flipped at random at each rate: the score is the mean fuzz.ratio of the
+# two legacy strings. Unrelated fingerprints differ in half their bits, and score about 63.
+
+_CALIBRATION_RATE = np.array([0.0, 0.01, 0.02, 0.04, 0.06, 0.08, 0.10, 0.12, 0.15, 0.18, 0.21, 0.24, 0.27, 0.30, 0.35, 0.40, 0.50])
+_CALIBRATION_SCORE = np.array([100.0, 98.2, 96.3, 92.8, 89.6, 86.8, 83.9, 81.3, 77.8, 74.7, 72.1, 69.8, 67.9, 66.3, 64.6, 63.4, 62.9])
+
+# Bits set in each 16-bit value, for NumPy before 2.0
+_POPCOUNT16 = np.unpackbits(np.arange(65536, dtype=np.uint16).view(np.uint8)).reshape(-1, 16).sum(axis=1).astype(np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """The number of bits set in each uint32 word."""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(words)
+    return _POPCOUNT16[words & 0xFFFF] + _POPCOUNT16[words >> 16]
+
+
+def fingerprintMatrix(fingerprints: Sequence[np.ndarray], width: int = LEGACY_WORDS) -> Tuple[np.ndarray, np.ndarray]:
+    """Fingerprints as the rows of one uint32 matrix, zero-padded to width words, and their lengths."""
+    matrix = np.zeros((len(fingerprints), width), dtype=np.uint32)
+    lengths = np.zeros(len(fingerprints), dtype=np.int64)
+    for row, words in enumerate(fingerprints):
+        words = words[:width]
+        matrix[row, :len(words)] = words
+        lengths[row] = len(words)
+    return matrix, lengths
+
+
+# Fingerprints compared with one track at a time: enough to be quick, few enough to stay in cache
+_BLOCK = 4096
+
+
+def bitErrorRates(matrix: np.ndarray, lengths: np.ndarray, track: int, others: np.ndarray,
+                  maxOffset: int = 0, minOverlap: int = 40) -> np.ndarray:
+    """
+    The bit error rate between one fingerprint and each of a block of others, all rows of a
+    fingerprintMatrix: the lowest over alignments up to maxOffset words either way. Where
+    fewer than minOverlap words overlap, the rate is 0.5, as for unrelated audio.
+    """
+    others = np.asarray(others, dtype=np.int64)
+    rates = np.full(len(others), 0.5)
+    for start in range(0, len(others), _BLOCK):
+        rates[start:start + _BLOCK] = _blockErrorRates(matrix, lengths, track, others[start:start + _BLOCK], maxOffset, minOverlap)
+    return rates
+
+
+def _blockErrorRates(matrix, lengths, track, others, maxOffset, minOverlap):
+    # A run of consecutive tracks, as in a brute-force search, needn't be copied
+    if len(others) and others[-1] - others[0] == len(others) - 1 and (np.diff(others) == 1).all():
+        block = matrix[others[0]:others[-1] + 1]
+    else:
+        block = matrix[others]
+    return _errorRates(matrix[track:track + 1], lengths[track:track + 1], block, lengths[others], maxOffset, minOverlap)
+
+
+def pairErrorRates(matrix: np.ndarray, lengths: np.ndarray, pairs: np.ndarray,
+                   maxOffset: int = 0, minOverlap: int = 40) -> np.ndarray:
+    """
+    As bitErrorRates(), for any pairs of rows of a fingerprintMatrix, given as an (n, 2)
+    array. Each block of pairs is scored in one vectorised pass, however many tracks it spans.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    rates = np.full(len(pairs), 0.5)
+    for start in range(0, len(pairs), _BLOCK):
+        block = pairs[start:start + _BLOCK]
+        rates[start:start + _BLOCK] = _errorRates(matrix[block[:, 0]], lengths[block[:, 0]], matrix[block[:, 1]], lengths[block[:, 1]],
+                                                  maxOffset, minOverlap)
+    return rates
+
+
+def _errorRates(left, leftLengths, right, rightLengths, maxOffset, minOverlap):
+    # Each row of left against the same row of right, or a single row of left against every row
+    width = right.shape[1]
+    counting = np.uint16 if 32 * width < 65536 else np.int64
+    best = np.full(len(right), 0.5)
+    for offset in range(-maxOffset, maxOffset + 1):
+        # Word k of the left fingerprint against word k + offset of the right one
+        if offset >= 0:
+            differences = left[:, :width - offset] ^ right[:, offset:]
+            overlap = np.minimum(leftLengths, rightLengths - offset)
+        else:
+            differences = left[:, -offset:] ^ right[:, :width + offset]
+            overlap = np.minimum(leftLengths + offset, rightLengths)
+        # Beyond the shorter fingerprint, the padding of one meets the words of the other
+        if (overlap < width - abs(offset)).any():
+            differences[np.arange(width - abs(offset)) >= overlap[:, np.newaxis]] = 0
+        errors = popcount(differences).sum(axis=1, dtype=counting)
+        rates = np.where(overlap >= minOverlap, errors / (32.0 * np.maximum(overlap, 1)), 0.5)
+        np.minimum(best, rates, out=best)
+    return best
+
+
+def matchScore(rates: np.ndarray) -> np.ndarray:
+    """Bit error rates on the 0 to 100 scale of fuzz.ratio, as used by dedup.py --match."""
+    return np.interp(rates, _CALIBRATION_RATE, _CALIBRATION_SCORE)
@@ -0,0 +1,518 @@
+#!/usr/bin/python3
+# This is a MODULE
+#
+# Helpers shared by cue_playlist.py and nocue_playlist.py while they import
+# a playlist into a mezzanine directory.
+
+import json
+import math
+import os
+import re
+import resource
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set
+
+FFMPEG = "/usr/local/bin/ffmpeg"
+
+# 32-hex MD5 token, as used in mezzanine filenames
+MD5HashRE = re.compile(r'(?i)(?<![a-z0-9])[a-f0-9]{32}(?![a-z0-9])')
+
+
+# --- Mezzanine hash index ---
+
+class MezzanineIndex(object):
+    """
+    Map from audio hash to mezzanine filename for one mezzanine directory.
+
+    The directory is listed once, when the index is built, instead of being
+    globbed for every track. Hashes are added as tracks are claimed for
+    encoding, so the index stays current for the rest of the run. All
+    methods are safe to call from several worker threads.
+
+    A long-running process can rescan() the directory from time to time,
+    to see files added or removed by other tools. An indexed file that has
+    gone is noticed in any case when a track with the same audio arrives.
+
+    Workers processing a playlist take turns to claim, in playlist order,
+    so that of several entries with the same audio the first always wins,
+    however many run at once.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.lock = threading.Lock()
+        # Hashes claimed or adopted during this run, as opposed to found in the directory
+        self.claimed: Set[str] = set()
+        # Hashes claimed whose files aren't finished yet
+        self.pending: Set[str] = set()
+        # Playlist positions before nextTurn, and those in passedTurns, have had their turn to claim
+        self.turns = threading.Condition(self.lock)
+        self.nextTurn = 0
+        self.passedTurns: Set[int] = set()
+        self.hashes: Dict[str, str] = self.scan()
+        print("Indexed %s hashes in %s." % (len(self.hashes), directory))
+
+    def scan(self) -> Dict[str, str]:
+        """List the directory: the hash of every mezzanine file in it, and the file."""
+        hashes: Dict[str, str] = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".mka"):
+                    continue
+                for found in MD5HashRE.findall(entry.name):
+                    hashes.setdefault(found.lower(), entry.path)
+        return hashes
+
+    def rescan(self) -> None:
+        """List the directory again. Claims not yet finished are kept."""
+        with self.lock:
+            hashes = self.scan()
+            for pending in self.pending:
+                hashes[pending] = self.hashes[pending]
+            self.hashes = hashes
+
+    def lookup(self, hashout: str) -> Optional[str]:
+        """Return the mezzanine file holding this hash, or None."""
+        with self.lock:
+            return self.hashes.get(hashout.lower())
+
+    def claim(self, hashout: str, filename: str) -> bool:
+        """
+        Record that 'filename' will hold the audio with this hash.
+        Returns False, and records nothing, if the hash is already in the
+        directory or has been claimed by another track during this run.
+        An indexed file that has since been deleted doesn't count.
+        """
+        with self.lock:
+            existing = self.hashes.get(hashout.lower())
+            if existing is not None and (hashout.lower() in self.pending or os.path.exists(existing)):
+                return False
+            self.hashes[hashout.lower()] = filename
+            self.claimed.add(hashout.lower())
+            self.pending.add(hashout.lower())
+            return True
+
+    def finish(self, hashout: str) -> None:
+        """Record that the file claimed for this hash has been made."""
+        with self.lock:
+            self.pending.discard(hashout.lower())
+
+    def adopt(self, hashout: str, filename: str) -> bool:
+        """
+        Claim a mezzanine file that was already in the directory under
+        exactly this name, such as one finished by an interrupted run just
+        before it died. Returns False if the hash is held by another file,
+        or has already been claimed or adopted during this run.
+        """
+        with self.lock:
+            if self.hashes.get(hashout.lower()) != filename or hashout.lower() in self.claimed:
+                return False
+            self.claimed.add(hashout.lower())
+            return True
+
+    def waitTurn(self, order: Optional[int]) -> None:
+        """Wait until every playlist position before 'order' has had its turn to claim."""
+        if order is None:
+            return
+        with self.lock:
+            self.turns.wait_for(lambda: self.nextTurn >= order)
+
+    def passTurn(self, order: Optional[int]) -> None:
+        """
+        Finish the turn of this playlist position, whether or not it claimed
+        anything. Passing a turn more than once does no harm.
+        """
+        if order is None:
+            return
+        with self.lock:
+            if order >= self.nextTurn:
+                self.passedTurns.add(order)
+            while self.nextTurn in self.passedTurns:
+                self.passedTurns.discard(self.nextTurn)
+                self.nextTurn += 1
+            self.turns.notify_all()
+
+    def release(self, hashout: str, filename: str) -> None:
+        """
+        Withdraw a claim made by claim(), when 'filename' couldn't be made.
+        The audio can then be claimed again, by this run or a later one.
+        """
+        with self.lock:
+            if self.hashes.get(hashout.lower()) == filename:
+                del self.hashes[hashout.lower()]
+                self.claimed.discard(hashout.lower())
+                self.pending.discard(hashout.lower())
+
+
+_indexes: Dict[str, MezzanineIndex] = {}
+_registryLock = threading.Lock()
+
+
+def mezzanineIndex(directory: str) -> MezzanineIndex:
+    """
+    Return the index for a mezzanine directory, building it on first use.
+    Every caller in the process shares the same index.
+    """
+    directory = os.path.abspath(directory)
+    with _registryLock:
+        if directory not in _indexes:
+            _indexes[directory] = MezzanineIndex(directory)
+        return _indexes[directory]
+
+
+# --- Content hash cache ---
+
+class HashCache(object):
+    """
+    Persistent map from a source file's identity, (device, inode, size,
+    mtime_ns), to the MD5 hash of its audio.
+
+    A source that hasn't changed since it was last hashed is recognised with a
+    single stat(), instead of decoding it all again. Entries are kept as JSON
+    lines, appended and flushed as each hash is learned, so the file is shared
+    safely by runs of cue_playlist.py and nocue_playlist.py. When the same
+    identity appears more than once, the last entry wins.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes: Dict[tuple, str] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self.hashes[(rec["dev"], rec["ino"], rec["size"], rec["mtime_ns"])] = rec["md5"]
+                    except (ValueError, KeyError):
+                        # A line cut short by an interrupted run
+                        continue
+        print("Loaded %s cached hashes from %s." % (len(self.hashes), path))
+
+    @staticmethod
+    def identity(st: os.stat_result) -> tuple:
+        return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def get(self, filename: str) -> Optional[str]:
+        """Return the cached hash for filename, or None if it is new or has changed."""
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        with self.lock:
+            return self.hashes.get(self.identity(st))
+
+    def put(self, filename: str, md5: str, st: Optional[os.stat_result] = None) -> None:
+        """
+        Record the hash of filename. Pass the stat() taken before hashing
+        began, so that a file changed while it was being hashed isn't matched
+        to the wrong hash next time.
+        """
+        if st is None:
+            st = os.stat(filename)
+        key = self.identity(st)
+        rec = {"dev": key[0], "ino": key[1], "size": key[2], "mtime_ns": key[3],
+               "md5": md5, "path": filename}
+        with self.lock:
+            self.hashes[key] = md5
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+
+_hashCaches: Dict[str, HashCache] = {}
+
+
+def hashCache(path: str) -> Optional[HashCache]:
+    """
+    Return the hash cache stored at path, loading it on first use, or None if
+    no path is given. Every caller in the process shares the same cache.
+    """
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    with _registryLock:
+        if path not in _hashCaches:
+            _hashCaches[path] = HashCache(path)
+        return _hashCaches[path]
+
+
+# --- Fast packet-level hashes ---
+#
+# The hash in a mezzanine filename is the MD5 of the decoded audio, which means decoding the
+# whole file. The compressed packets can be hashed instead at disk speed, with -c copy.
+# A side table maps each packet hash to the decoded MD5 it stands for. Mezzanine files are
+# only ever named by the decoded MD5, so a packet hash the table doesn't know yet is decoded
+# once and recorded: otherwise the same audio could be given two names, one by each kind of
+# hash, and the hash cache would hold packet hashes where decoded MD5s belong.
+
+def packetHash(filename: str) -> str:
+    """MD5 of the compressed audio packets of filename, without decoding them."""
+    test = subprocess.check_output([FFMPEG, "-v", "quiet", "-hide_banner", "-i", filename, "-vn",
+                                    "-map", "0:a", "-c", "copy", "-f", "hash", "-hash", "MD5", "-"],
+                                   encoding='utf-8')
+    # The hash muxer writes a single line: MD5=<32 hex digits>
+    return test.strip().split("=")[-1]
+
+
+class HashMap(object):
+    """
+    Persistent side table from packet hash to decoded-audio MD5, kept as
+    JSON lines and appended to as each pair is learned.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.hashes: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self.hashes[rec["packets"]] = rec["md5"]
+                    except (ValueError, KeyError):
+                        continue
+        print("Loaded %s packet hashes from %s." % (len(self.hashes), path))
+
+    def get(self, packets: str) -> Optional[str]:
+        with self.lock:
+            return self.hashes.get(packets)
+
+    def put(self, packets: str, md5: str) -> None:
+        with self.lock:
+            if self.hashes.get(packets) == md5:
+                return
+            self.hashes[packets] = md5
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"packets": packets, "md5": md5}) + "\n")
+
+
+_hashMaps: Dict[str, HashMap] = {}
+
+
+def hashMap(path: str) -> Optional[HashMap]:
+    """
+    Return the packet hash side table stored at path, loading it on first
+    use, or None if no path is given.
+    """
+    if not path:
+        return None
+    path = os.path.abspath(path)
+    with _registryLock:
+        if path not in _hashMaps:
+            _hashMaps[path] = HashMap(path)
+        return _hashMaps[path]
+
+
+def contentHash(filename: str, decodedHash: Callable[[], str], fast: bool = False,
+                cacheFile: Optional[str] = None, mapFile: Optional[str] = None) -> str:
+    """
+    Return the 32-hex identity of the audio in filename, as used in
+    mezzanine filenames.
+
+    decodedHash is called to compute the MD5 of the decoded audio when it is
+    needed. It isn't needed when the hash cache at cacheFile already knows
+    this unchanged file, nor in fast mode when the side table at mapFile
+    already knows the file's packet hash. Either way, the side table is
+    filled in with the packet hash of every file that has to be decoded.
+    The result is always a decoded MD5, whichever way it was found.
+    """
+    cache = hashCache(cacheFile)
+    hashout = cache.get(filename) if cache else None
+    if hashout:
+        print("MD5 hash found in hash cache.")
+        return hashout
+    st = os.stat(filename) if cache else None
+
+    table = hashMap(mapFile)
+    if fast:
+        packets = packetHash(filename)
+        hashout = table.get(packets) if table else None
+        if hashout:
+            print("Packet hash %s is known as MD5 hash %s." % (packets, hashout))
+        else:
+            hashout = decodedHash()
+            if table:
+                table.put(packets, hashout)
+    else:
+        hashout = decodedHash()
+        if table:
+            table.put(packetHash(filename), hashout)
+
+    if cache:
+        cache.put(filename, hashout, st)
+    return hashout
+
+
+# --- Resumable processing journal ---
+
+class Journal(object):
+    """
+    Append-only record of the playlist entries that have been processed,
+    with the result analyse() returned for each.
+
+    Every entry is flushed to disk as soon as its track is finished, so after
+    a crash or power cut the journal holds everything that was completed.
+    Entries are keyed by their position in the playlist and checked against
+    the source filename, so a journal left by a different playlist is never
+    trusted. Results must be JSON-serialisable.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.results: Dict[int, tuple] = {}
+        if resume and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                        self.results[rec["index"]] = (rec["source"], rec["result"])
+                    except (ValueError, KeyError):
+                        # The entry being written when the run died
+                        continue
+            print("Resuming: %s entries already processed according to %s." % (len(self.results), path))
+            self.journal = open(path, "a", encoding="utf-8")
+        else:
+            self.journal = open(path, "w", encoding="utf-8")
+
+    def completed(self, index: int, source: str) -> bool:
+        """True if the entry at this position, for this source, is already done."""
+        return index in self.results and self.results[index][0] == source
+
+    def result(self, index: int):
+        """The recorded result of a completed entry."""
+        return self.results[index][1]
+
+    def record(self, index: int, source: str, result) -> None:
+        """Append a completed entry, and make sure it reaches the disk."""
+        line = json.dumps({"index": index, "source": source, "result": result}, ensure_ascii=False)
+        with self.lock:
+            self.results[index] = (source, result)
+            self.journal.write(line + "\n")
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def run(self, index: int, source: str, func: Callable, *args, **kwargs):
+        """Call func, record its result against this entry, and return it."""
+        result = func(*args, **kwargs)
+        self.record(index, source, result)
+        return result
+
+    def finish(self) -> None:
+        """Close the journal and remove it, once the whole playlist is written."""
+        self.journal.close()
+        os.remove(self.path)
+
+
+# --- Per-stage timings ---
+#
+# When timings are switched on, every stage of the work on every file is recorded as a JSON
+# line: wall time, CPU time of this thread (the Python side, e.g. parsing), CPU time of the
+# FFmpeg children reaped during the stage, and bytes read from disk (block input operations
+# of this process and its children, which a network filesystem may not report).
+# getrusage(RUSAGE_CHILDREN) covers the whole process, so with several jobs at once, the
+# children's CPU and bytes are shared out by whichever stages were running as each child ended.
+
+class StageTimer(object):
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.records: List[Dict] = []
+        self.out = open(path, "w", encoding="utf-8")
+        self.local = threading.local()
+
+    @contextmanager
+    def stage(self, filename: str, stage: str):
+        depth = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        selfStart = resource.getrusage(resource.RUSAGE_SELF)
+        childStart = resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpuStart = time.thread_time()
+        wallStart = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wallStart
+            cpu = time.thread_time() - cpuStart
+            selfEnd = resource.getrusage(resource.RUSAGE_SELF)
+            childEnd = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.local.depth = depth
+            rec = {"file": filename, "stage": stage, "depth": depth,
+                   "wall": round(wall, 6), "cpu": round(cpu, 6),
+                   "child_cpu": round((childEnd.ru_utime + childEnd.ru_stime)
+                                      - (childStart.ru_utime + childStart.ru_stime), 6),
+                   "bytes_read": 512 * ((selfEnd.ru_inblock - selfStart.ru_inblock)
+                                        + (childEnd.ru_inblock - childStart.ru_inblock))}
+            with self.lock:
+                self.records.append(rec)
+                self.out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                self.out.flush()
+
+    def summary(self, slowest: int = 10) -> str:
+        """A table of totals and percentiles per stage, and the slowest files."""
+        with self.lock:
+            records = list(self.records)
+
+        def percentile(values, p):
+            # Nearest-rank percentile of a sorted list
+            return values[max(0, math.ceil(p / 100.0 * len(values)) - 1)]
+
+        lines = ["%-10s %6s %10s %10s %10s %12s %8s %8s %8s %8s" % (
+            "stage", "count", "wall s", "cpu s", "child s", "MB read", "p50 s", "p90 s", "p99 s", "max s")]
+        stages: Dict[str, List[Dict]] = {}
+        for rec in records:
+            stages.setdefault(rec["stage"], []).append(rec)
+        for stage, recs in stages.items():
+            walls = sorted(r["wall"] for r in recs)
+            lines.append("%-10s %6d %10.2f %10.2f %10.2f %12.1f %8.3f %8.3f %8.3f %8.3f" % (
+                stage, len(recs), sum(walls), sum(r["cpu"] for r in recs),
+                sum(r["child_cpu"] for r in recs), sum(r["bytes_read"] for r in recs) / 1e6,
+                percentile(walls, 50), percentile(walls, 90), percentile(walls, 99), walls[-1]))
+
+        # Nested stages are already counted in the stage around them
+        perFile: Dict[str, float] = {}
+        for rec in records:
+            if rec["depth"] == 0:
+                perFile[rec["file"]] = perFile.get(rec["file"], 0.0) + rec["wall"]
+        lines.append("")
+        lines.append("Slowest files:")
+        for filename, wall in sorted(perFile.items(), key=lambda x: -x[1])[:slowest]:
+            lines.append("%10.2f s  %s" % (wall, filename))
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        self.out.close()
+
+
+_timer: Optional[StageTimer] = None
+
+
+def startTimings(path: str) -> StageTimer:
+    """Switch timings on for this process, writing JSON lines to path."""
+    global _timer
+    _timer = StageTimer(path)
+    return _timer
+
+
+@contextmanager
+def stage(filename: str, name: str):
+    """Time a stage of the work on filename, if timings are switched on."""
+    if _timer is None:
+        yield
+    else:
+        with _timer.stage(filename, name):
+            yield
+
+
+def finishTimings() -> None:
+    """Print the timings summary and close the timings file, if timings are on."""
+    global _timer
+    if _timer is None:
+        return
+    print(_timer.summary())
+    _timer.close()
+    _timer = None
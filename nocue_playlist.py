@@ -1,14 +1,22 @@
 #!/usr/bin/python3
 
-import subprocess, argparse, os, os.path, random, string, tempfile, csv, re, shutil
-from pathlib import Path
+import subprocess, argparse, os, os.path, random, string, tempfile, csv, re, shutil, concurrent.futures
+import ingest
 
 FFMPEG = "/usr/local/bin/ffmpeg"
 MEZZANINE = "-acodec libfdk_aac -vbr 5 -ac 2 -map 0:a"
 MD5HashRE = re.compile(r'(?i)(?<![a-z0-9])[a-f0-9]{32}(?![a-z0-9])')
 
-def analyse(filename, mezzanine=None, forceEncode=False):
+def analyse(filename, mezzanine=None, forceEncode=False, hashCacheFile=None, fastHash=False, hashMapFile=None, adopt=False, order=None):
     # Encode and store a mezzanine file, if a mezzanine directory name is given
+    # If hashCacheFile is given, content hashes are looked up there by the source's inode, size
+    # and modification time before decoding the file to hash it.
+    # If fastHash is set, the compressed packets are hashed first, and hashMapFile translates them
+    # to decoded-audio hashes. Only audio it doesn't know yet is decoded.
+    # If adopt is set, a mezzanine file already in the directory under the very name this track
+    # would be given is taken as made for it by an interrupted run, instead of being skipped.
+    # order is the track's position in the playlist. Tracks with the same audio claim it in this
+    # order, so the first of them is the one encoded, as when they are processed one at a time.
 
     print("Processing filename: %s" % filename)
     # If we're being asked to create a mezzanine file, we need to make a unique suffix for this file
@@ -16,8 +24,13 @@ def analyse(filename, mezzanine=None, forceEncode=False):
     # so that we do not waste time encoding it twice. FFmpeg provides a hash function for this.
     # Incidentally, this might be a way of detecting duplicate tracks, too.
     if mezzanine:
-        hashout = str(subprocess.check_output([FFMPEG, "-v", "quiet", "-hide_banner", "-i", filename, "-vn", \
-                "-map", "0:a", "-f", "hash", "-hash", "MD5", "-"], stderr=subprocess.STDOUT))[6:-3]
+        def decodedHash():
+            return(str(subprocess.check_output([FFMPEG, "-v", "quiet", "-hide_banner", "-i", filename, "-vn", \
+                    "-map", "0:a", "-f", "hash", "-hash", "MD5", "-"], stderr=subprocess.STDOUT))[6:-3])
+
+        # An unchanged source that has been hashed before is recognised from its stat() alone.
+        with ingest.stage(filename, "hash"):
+            hashout = ingest.contentHash(filename, decodedHash, fast=fastHash, cacheFile=hashCacheFile, mapFile=hashMapFile)
 
         print("MD5 hash is: %s" % hashout)
         #randomString = ''.join(random.choice(string.ascii_letters) for i in range(6))
@@ -51,12 +64,18 @@ def analyse(filename, mezzanine=None, forceEncode=False):
         # If it contains an entry, the track has already been converted, and we
         # need to abandon the process.
         print("Looking for file containing hash.")
-        p = Path(mezzanine+'/')
-        findMe = mezzanine + '/' + '[FILENAME]' + hashout + '*.mka'
-        print("Path object is:", p)
-        print("Glob search is:", findMe)
-        pl = list(p.glob('*'+hashout+'*.mka'))
-        if len(pl) != 0: # There is already a file with this hash
+        # The index lists the mezzanine directory once per run, rather than globbing it for every
+        # track. Claiming the hash also stops two workers encoding the same audio at once.
+        index = ingest.mezzanineIndex(mezzanine)
+        with ingest.stage(filename, "index"):
+            index.waitTurn(order)
+            claimed = index.claim(hashout, mezzanineName)
+            adopted = not claimed and adopt and index.adopt(hashout, mezzanineName)
+            index.passTurn(order)
+        if adopted:
+            print("This track's mezzanine file was made by an interrupted run. Not encoding.")
+            return({"mezzanine_name": mezzanineName})
+        if not claimed:
             print("This hash already exists! Not encoding.")
             return(None)
         print("No file found with that hash. Encoding.")
@@ -64,9 +83,12 @@ def analyse(filename, mezzanine=None, forceEncode=False):
     else:
         mezzanineName = None
 
-    # At this point, the file of interest is EITHER the original file, OR a mezzanine name.
-    if mezzanine:
-        print("Creating mezzanine file.")
+    # If anything goes wrong from here on, give up the claim on the hash, so that the file
+    # is tried again instead of being taken as already ingested.
+    try:
+        # At this point, the file of interest is EITHER the original file, OR a mezzanine name.
+        if mezzanine:
+            print("Creating mezzanine file.")
 
 #        # We need a temporary filename for FFmpeg to write to. We can't write metadata in place, because
 #        # the position of other elements in the file would change.
@@ -78,32 +100,45 @@ def analyse(filename, mezzanine=None, forceEncode=False):
 #        print("We are NOT creating a new file.")
 #
 
-        if mezzanineName == filename:
-            # No! FFmpeg can do bad things if replacing a file in-place
-            raise ValueError("mezzanineName must be different from filename!")
-
-        dest_dir = os.path.dirname(mezzanineName) or "."
-
-        if not os.path.isdir(dest_dir):
-            raise FileNotFoundError(f"Destination directory does not exist: {dest_dir}")
-
-        print("Creating mezzanine file.")
-
-        cmd = [FFMPEG, "-hide_banner", "-loglevel", "error", "-y",
-               "-i", filename,
-               "-map", "0:a",
-               "-c", "copy",
-               "-map_metadata", "0",
-               "-map_metadata:s:a", "0:s:a",
-               "-map_chapters", "-1",
-               mezzanineName]
-        print("debug: CMD is %s" % cmd)
-        rc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print("debug: returned from FFmpeg")
-
-        if rc.returncode != 0:
-            raise RuntimeError(f"FFmpeg failed: {rc.stderr.decode(errors='ignore')}")
-        print("Mezzanine created at:", mezzanineName)
+            if mezzanineName == filename:
+                # No! FFmpeg can do bad things if replacing a file in-place
+                raise ValueError("mezzanineName must be different from filename!")
+
+            dest_dir = os.path.dirname(mezzanineName) or "."
+
+            if not os.path.isdir(dest_dir):
+                raise FileNotFoundError(f"Destination directory does not exist: {dest_dir}")
+
+            print("Creating mezzanine file.")
+
+            # Write under a temporary name and rename into place, so that a run that dies part
+            # way through never leaves a truncated file that looks like a finished mezzanine.
+            partName = mezzanineName + ".part"
+            cmd = [FFMPEG, "-hide_banner", "-loglevel", "error", "-y",
+                   "-i", filename,
+                   "-map", "0:a",
+                   "-c", "copy",
+                   "-map_metadata", "0",
+                   "-map_metadata:s:a", "0:s:a",
+                   "-map_chapters", "-1",
+                   "-f", "matroska", partName]
+            print("debug: CMD is %s" % cmd)
+            with ingest.stage(filename, "remux"):
+                rc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            print("debug: returned from FFmpeg")
+
+            if rc.returncode != 0:
+                if os.path.exists(partName):
+                    os.remove(partName)
+                raise RuntimeError(f"FFmpeg failed: {rc.stderr.decode(errors='ignore')}")
+            os.replace(partName, mezzanineName)
+            print("Mezzanine created at:", mezzanineName)
+    except BaseException:
+        if mezzanine:
+            ingest.mezzanineIndex(mezzanine).release(hashout, mezzanineName)
+        raise
+    if mezzanine:
+        ingest.mezzanineIndex(mezzanine).finish(hashout)
     return({"mezzanine_name": mezzanineName})
 
 
@@ -113,7 +148,18 @@ parser = argparse.ArgumentParser(description="Create start and end-of-track anno
 parser.add_argument("playlist", help="Playlist file to be processed")
 parser.add_argument("-o", "--output", help="Output filename (default: '-processed' suffix)", type=str)
 parser.add_argument("-m", "--mezzanine", help="Directory for mezzanine-format files", type=str)
+parser.add_argument("--hash-cache", help="File caching the content hash of each source file, "
+                    "so that unchanged files needn't be decoded to be recognised", type=str)
+parser.add_argument("--fast-hash", help="Identify audio by hashing its compressed packets. Only audio whose packet hash isn't yet in --hash-map is decoded", action="store_true")
+parser.add_argument("--hash-map", help="File mapping packet hashes to decoded-audio hashes. "
+                    "Read with --fast-hash, and filled in whenever audio is decoded to hash it", type=str)
+parser.add_argument("-r", "--resume", help="Carry on from where an interrupted run stopped, using its journal", action="store_true")
+parser.add_argument("-t", "--timings", help="Record the time taken by each stage for each file as JSON lines "
+                    "in this file, and print a summary at the end", type=str)
+parser.add_argument("-j", "--jobs", help="Number of tracks to process at once. Default: 1", default=1, type=int)
 args = parser.parse_args()
+if args.fast_hash and not args.hash_map:
+    parser.error("--fast-hash needs a --hash-map to remember what it has decoded")
 
 playlist = args.playlist
 
@@ -133,6 +179,8 @@ if args.mezzanine:
     except OSError:
         print("Sorry, the directory %s is weird. Might be a file?" % mezzanine)
         exit(1)
+    # Index the hashes already in the mezzanine directory before any work starts
+    ingest.mezzanineIndex(mezzanine)
 else:
     mezzanine = None
 
@@ -144,14 +192,56 @@ with open(playlist) as i:
 
 print("We have read %s items." % len(playlistLines))
 
-with open(outfile, mode="w") as out:
+# Every finished track is recorded in the journal as soon as it is done. After a crash,
+# --resume skips those tracks and rebuilds the output playlist from their recorded results.
+journal = ingest.Journal(outfile + ".journal", resume=args.resume)
+
+if args.timings:
+    ingest.startTimings(args.timings)
+
+print("Processing %s tracks at once." % args.jobs)
+
+# Skip the M3U indicator
+playlistItems = [item for item in playlistLines if item != "#EXTM3U\n"]
+
+# Tracks are handed to a pool of workers. The heavy lifting is done by FFmpeg child processes,
+# so threads are enough to keep the cores busy. Results are collected in playlist order, so the
+# output playlist keeps the order of the input whatever order the tracks finish in.
+# The mezzanine files of tracks already in the journal are theirs, so no other track may adopt them.
+if mezzanine:
+    for index, item in enumerate(playlistItems):
+        if journal.completed(index, item.strip()) and journal.result(index) and journal.result(index)["mezzanine_name"]:
+            name = journal.result(index)["mezzanine_name"]
+            ingest.mezzanineIndex(mezzanine).adopt(re.search(MD5HashRE, os.path.basename(name)).group(0), name)
+
+# Tracks claim their audio in playlist order. One that fails before its turn comes has the turn
+# passed for it here, and those already in the journal have had theirs, so no track waits for ever.
+def analyseInTurn(order, **kwargs):
+    try:
+        return(analyse(order=order, **kwargs))
+    finally:
+        if mezzanine:
+            ingest.mezzanineIndex(mezzanine).passTurn(order)
+
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor, open(outfile, mode="w") as out:
+    futures = []
+    for index, item in enumerate(playlistItems):
+        if journal.completed(index, item.strip()):
+            if mezzanine:
+                ingest.mezzanineIndex(mezzanine).passTurn(index)
+            futures.append(None)
+        else:
+            futures.append(executor.submit(journal.run, index, item.strip(), analyseInTurn, order=index, filename=item.strip(), mezzanine=mezzanine, \
+                    forceEncode=False, hashCacheFile=args.hash_cache, fastHash=args.fast_hash, hashMapFile=args.hash_map, adopt=args.resume))
     out.write("#EXTM3U\n")
 
-    for item in playlistLines:
-        # Skip the M3U indicator
-        if item == "#EXTM3U\n":
-            continue
-        result = analyse(filename=item.strip(), mezzanine=mezzanine, forceEncode=False)
+    for index, (item, future) in enumerate(zip(playlistItems, futures)):
+        try:
+            result = journal.result(index) if future is None else future.result()
+        except BaseException:
+            # Don't start any more tracks once one has failed
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
         # analyse() returns None if the audio has already been converted.
         # At this point, we can skip writing a new line to the playlist, because the file is already
         # extant, and must have been referenced already within the playlist we're creating.
@@ -173,4 +263,6 @@ with open(outfile, mode="w") as out:
         #fd.close()
         #print("Fingerprint is:")
         #print(fing)
+journal.finish()
+ingest.finishTimings()
 print("Done.")
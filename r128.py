@@ -0,0 +1,477 @@
+#!/usr/bin/python3
+# This is a MODULE
+#
+# Helpers for the EBU R.128 loudness measurements that FFmpeg's
+# ebur128=metadata=1,ametadata=mode=print filter chain prints, one frame
+# (10 per second) at a time:
+#
+#   frame:0    pts:0       pts_time:0
+#   lavfi.r128.M=-120.691
+#   lavfi.r128.S=-120.691
+#   lavfi.r128.I=-70.000
+#   lavfi.r128.LRA=0.000
+#   lavfi.r128.LRA.low=0.000
+#   lavfi.r128.LRA.high=0.000
+#
+# and, with ebur128=peak=true, the running true-peak of each channel and of them all (linear):
+#
+#   lavfi.r128.true_peaks_ch0=0.000
+#   lavfi.r128.true_peak=0.000
+
+import os
+import sys
+import tempfile
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+# A track whose fade-out trigger is further than this from its end has a long, quiet
+# but important tail ("Bohemian Rhapsody"). Its trigger is searched again, this many LU lower.
+LONG_TAIL = 15.0
+
+
+def readFrames(lines: Iterable[str]) -> Dict:
+    """
+    Parse ametadata output line by line, as it arrives from FFmpeg.
+
+    Only compact running state is kept: the frame times and momentary loudness
+    go into two float arrays, the highest short-term loudness is kept as it
+    goes, and the integrated loudness, loudness range, true-peak and duration
+    are taken from the last complete frame.
+
+    Every frame starts with a 'frame:' header, so the parser resynchronises on
+    those headers. A frame without a momentary loudness value is dropped, and
+    stray lines are ignored, rather than abandoning the whole file.
+
+    Returns {"times": ndarray, "momentary": ndarray, "loudness": float,
+    "duration": float, "dropped": int, "short_term_max": float, "lra": float,
+    "true_peak": float}. The true-peak is in dBTP, or None if FFmpeg wasn't
+    asked for it.
+    """
+    times = array('d')
+    momentary = array('d')
+    loudness = None
+    shortTermMax = None
+    lra = None
+    truePeak = None
+    dropped = 0
+
+    frameTime = None
+    frameM = None
+    frameI = None
+    frameS = None
+    frameLRA = None
+    framePeak = None
+
+    def finishFrame():
+        nonlocal loudness, shortTermMax, lra, truePeak, dropped
+        if frameTime is None:
+            return
+        if frameM is None:
+            dropped += 1
+            return
+        times.append(frameTime)
+        momentary.append(frameM)
+        if frameI is not None:
+            loudness = frameI
+        if frameS is not None and (shortTermMax is None or frameS > shortTermMax):
+            shortTermMax = frameS
+        if frameLRA is not None:
+            lra = frameLRA
+        if framePeak is not None:
+            truePeak = framePeak
+
+    for line in lines:
+        line = line.strip()
+        try:
+            if line.startswith('frame:'):
+                finishFrame()
+                # The time is the last field: pts_time:<seconds>
+                frameTime = float(line.split(":")[-1])
+                frameM = None
+                frameI = None
+                frameS = None
+                frameLRA = None
+                framePeak = None
+            elif line.startswith('lavfi.r128.M='):
+                frameM = float(line.split("=")[-1])
+            elif line.startswith('lavfi.r128.I='):
+                frameI = float(line.split("=")[-1])
+            elif line.startswith('lavfi.r128.S='):
+                frameS = float(line.split("=")[-1])
+            elif line.startswith('lavfi.r128.LRA='):
+                frameLRA = float(line.split("=")[-1])
+            elif line.startswith('lavfi.r128.true_peak='):
+                framePeak = float(line.split("=")[-1])
+        except ValueError:
+            # A truncated or garbled line. Drop the frame it belongs to.
+            frameTime = None
+            dropped += 1
+    finishFrame()
+
+    if dropped:
+        print("Warning: skipped %s incomplete EBU R.128 frame(s)." % dropped, file=sys.stderr)
+
+    if not times or loudness is None:
+        raise RuntimeError("No EBU R.128 measurements were found.")
+
+    # Get duration. It's the frame pts given in the last frame.
+    return {"times": np.frombuffer(times), "momentary": np.frombuffer(momentary),
+            "loudness": loudness, "duration": times[-1], "dropped": dropped,
+            "short_term_max": shortTermMax, "lra": lra,
+            "true_peak": None if truePeak is None else peakToDB(truePeak)}
+
+
+def peakToDB(peak: float) -> float:
+    """A linear sample peak in dBFS (or dBTP), with silence as -120."""
+    return float(20 * np.log10(peak)) if peak > 1e-6 else -120.0
+
+
+def firstAbove(times, momentary, levels) -> np.ndarray:
+    """
+    For every level in 'levels', the time of the first frame whose momentary
+    loudness is above that level, or 0.0 if there is none.
+    All levels are searched in one vectorised pass.
+    """
+    levels = np.atleast_1d(np.asarray(levels, dtype=float))
+    if len(times) == 0:
+        return np.zeros(len(levels))
+    above = momentary[np.newaxis, :] > levels[:, np.newaxis]
+    index = np.argmax(above, axis=1)
+    return np.where(above.any(axis=1), times[index], 0.0)
+
+
+def lastAbove(times, momentary, levels) -> np.ndarray:
+    """
+    For every level in 'levels', the time of the last frame whose momentary
+    loudness is above that level, or 0.0 if there is none.
+    All levels are searched in one vectorised pass.
+    """
+    levels = np.atleast_1d(np.asarray(levels, dtype=float))
+    if len(times) == 0:
+        return np.zeros(len(levels))
+    above = momentary[np.newaxis, :] > levels[:, np.newaxis]
+    index = len(times) - 1 - np.argmax(above[:, ::-1], axis=1)
+    return np.where(above.any(axis=1), times[index], 0.0)
+
+
+def findCuePoints(times, momentary, loudness: float, duration: float,
+                  thresholds: List[Tuple[float, float]]) -> List[Dict]:
+    """
+    Find cue points for each (volDrop, volStart) pair in 'thresholds'.
+
+    cue_point is where the momentary loudness first rises above
+    loudness - volStart, less the 400ms the meter needs to fill its block.
+    start_next is how long before the end the momentary loudness last falls
+    below loudness - volDrop. Where that is more than LONG_TAIL seconds, the
+    track has a long tail, and the search is repeated LONG_TAIL LU lower.
+
+    Every crossing for every pair is found in one pass over the series.
+    Returns one dictionary per pair, in the order given.
+    """
+    drops = np.array([t[0] for t in thresholds], dtype=float)
+    starts = np.array([t[1] for t in thresholds], dtype=float)
+
+    cueTimes = firstAbove(times, momentary, loudness - starts)
+    # Normal and long-tail fade-out triggers, searched together
+    nextTimes = lastAbove(times, momentary, np.concatenate((loudness - drops, loudness - drops - LONG_TAIL)))
+    nextTimes, tailTimes = nextTimes[:len(drops)], nextTimes[len(drops):]
+
+    longTail = (duration - nextTimes) > LONG_TAIL
+    nextTimes = np.where(longTail, tailTimes, nextTimes)
+
+    # The EBU R.128 algorithm measures in 400ms blocks. Therefore, it marks 0.4s as the
+    # start of the track, even if its audio begins at 0.0s.
+    cuePoints = np.maximum(0, cueTimes - 0.4)
+    startNext = np.maximum(duration - nextTimes, 0)
+
+    return [{"volDrop": float(drops[i]), "volStart": float(starts[i]),
+             "cue_point": float(cuePoints[i]), "start_next": float(startNext[i]),
+             "next_time": float(nextTimes[i]), "longtail": str(bool(longTail[i]))}
+            for i in range(len(thresholds))]
+
+
+def findCuePointsInWindows(head: Dict, tail: Dict, tailStart: float, loudness: float, duration: float,
+                           thresholds: List[Tuple[float, float]]) -> Optional[List[Dict]]:
+    """
+    As findCuePoints(), but from measurements of only the start and the end of
+    a track: 'head' measured from the beginning, and 'tail' measured from
+    tailStart (its times already include the offset).
+
+    Returns None if any cue point might lie outside the two windows, in which
+    case the whole track must be measured.
+    """
+    for volDrop, volStart in thresholds:
+        # The cue-in point must be in the head window
+        if not np.any(head["momentary"] > loudness - volStart):
+            return None
+        # The fade-out trigger is either in the tail window, or so far before the end that the
+        # track has a long tail; and then the long-tail trigger must be in the tail window.
+        if not np.any(tail["momentary"] > loudness - volDrop):
+            if duration - tailStart <= LONG_TAIL + 0.4 or not np.any(tail["momentary"] > loudness - volDrop - LONG_TAIL):
+                return None
+
+    times = np.concatenate((head["times"], tail["times"]))
+    momentary = np.concatenate((head["momentary"], tail["momentary"]))
+    return findCuePoints(times, momentary, loudness, duration, thresholds)
+
+
+# --- In-process loudness meter ---
+#
+# A NumPy implementation of the BS.1770 / EBU R.128 meter, fed with 32-bit float PCM at
+# 48kHz (the rate FFmpeg's ebur128 filter also measures at), so that FFmpeg need only decode
+# the audio, rather than print seven lines of text for every 1/10 sec.
+# It follows FFmpeg's ebur128 filter: a momentary loudness every 100ms, over the last 400ms,
+# reported as -120.691 until the first 400ms have been heard; and an integrated loudness over
+# 400ms gating blocks with 75% overlap, gated at -70 LUFS and then 10 LU below the
+# absolute-gated loudness, which is -70 if nothing passes the gates.
+# Short-term loudness is over 3s, every 100ms. The loudness range (EBU Tech 3342) is the spread
+# between the 10th and 95th percentiles of the short-term loudness, gated at -70 LUFS and then
+# 20 LU below. True-peak is found by 4x oversampling with a 48-tap interpolating filter,
+# as in BS.1770 Annex 2.
+
+SAMPLE_RATE = 48000
+FRAME = SAMPLE_RATE // 10           # 100ms
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+LRA_GATE = -20.0
+SHORT_TERM = 30                     # 100ms frames in 3s
+OVERSAMPLE = 4
+SILENCE = 1e-12                     # FFmpeg's energy floor, giving -120.691 LUFS
+
+# K-weighting at 48kHz, from ITU-R BS.1770: a high shelf, then the RLB high-pass
+_SHELF = ([1.53512485958697, -2.69169618940638, 1.19839281085285], [1.0, -1.69065929318241, 0.73248077421585])
+_HIGHPASS = ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621])
+# Length of the K-weighting impulse response kept. The slowest pole decays below 1e-17
+# in this many samples, so the truncation is far below float32 resolution.
+_TAPS = 8192
+
+# Channel weights for the layouts FFmpeg reports: LFE is ignored, surrounds count 1.41 times
+_LAYOUTS = {
+    "mono": [1.0], "stereo": [1.0, 1.0], "2.1": [1.0, 1.0, 0.0], "3.0": [1.0, 1.0, 1.0],
+    "3.0(back)": [1.0, 1.0, 1.41], "4.0": [1.0, 1.0, 1.0, 1.41], "quad": [1.0, 1.0, 1.41, 1.41],
+    "quad(side)": [1.0, 1.0, 1.41, 1.41], "3.1": [1.0, 1.0, 1.0, 0.0],
+    "5.0": [1.0, 1.0, 1.0, 1.41, 1.41], "5.0(side)": [1.0, 1.0, 1.0, 1.41, 1.41],
+    "4.1": [1.0, 1.0, 1.0, 0.0, 1.41], "5.1": [1.0, 1.0, 1.0, 0.0, 1.41, 1.41],
+    "5.1(side)": [1.0, 1.0, 1.0, 0.0, 1.41, 1.41], "6.0": [1.0, 1.0, 1.0, 1.41, 1.41, 1.41],
+    "6.1": [1.0, 1.0, 1.0, 0.0, 1.41, 1.41, 1.41], "7.0": [1.0, 1.0, 1.0, 1.41, 1.41, 1.41, 1.41],
+    "7.1": [1.0, 1.0, 1.0, 0.0, 1.41, 1.41, 1.41, 1.41],
+    "7.1(wide)": [1.0, 1.0, 1.0, 0.0, 1.41, 1.41, 1.0, 1.0],
+}
+
+
+def channelWeights(channels: int, layout: Optional[str] = None) -> List[float]:
+    """BS.1770 weights for each channel of a layout, as FFmpeg names it."""
+    weights = _LAYOUTS.get(layout or "")
+    if weights is None or len(weights) != channels:
+        weights = _LAYOUTS["stereo" if channels == 2 else "mono"] if channels <= 2 else [1.0] * channels
+    return weights
+
+
+def _biquadImpulse(b, a, x: np.ndarray) -> np.ndarray:
+    y = np.zeros_like(x)
+    x1 = x2 = y1 = y2 = 0.0
+    for n in range(len(x)):
+        y[n] = b[0] * x[n] + b[1] * x1 + b[2] * x2 - a[1] * y1 - a[2] * y2
+        x2, x1 = x1, x[n]
+        y2, y1 = y1, y[n]
+    return y
+
+
+_kernel = None
+_peakKernels = None
+
+
+def _kWeightingKernel() -> np.ndarray:
+    global _kernel
+    if _kernel is None:
+        impulse = np.zeros(_TAPS)
+        impulse[0] = 1.0
+        _kernel = _biquadImpulse(*_HIGHPASS, _biquadImpulse(*_SHELF, impulse))
+    return _kernel
+
+
+def _truePeakKernels() -> np.ndarray:
+    # The interpolating filter's phases, one per row, each with unity gain at DC
+    global _peakKernels
+    if _peakKernels is None:
+        taps = 12 * OVERSAMPLE
+        n = np.arange(taps) - (taps - 1) / 2
+        prototype = np.sinc(n / OVERSAMPLE) * np.hanning(taps + 2)[1:-1]
+        phases = prototype.reshape(-1, OVERSAMPLE).T
+        _peakKernels = phases / phases.sum(axis=1, keepdims=True)
+    return _peakKernels
+
+
+class LoudnessMeter(object):
+    """
+    Streaming momentary and integrated loudness of 48kHz float PCM.
+
+    feed() takes blocks of interleaved samples of any length; the K-weighting
+    is applied as a fast convolution with the filters' impulse response, carrying
+    the overlap from one block to the next. Only one energy per 100ms is kept.
+    """
+
+    def __init__(self, channels: int, weights: Optional[List[float]] = None):
+        self.channels = channels
+        self.weights = np.asarray(weights if weights is not None else channelWeights(channels), dtype=float)
+        self.kernel = _kWeightingKernel()
+        self.overlap = np.zeros((len(self.kernel) - 1, channels))
+        self.partial = np.zeros(0)      # weighted power of samples not yet making a whole 100ms
+        self.frameEnergies = array('d')
+        self.peakKernels = _truePeakKernels()
+        self.peakHistory = np.zeros((self.peakKernels.shape[1] - 1, channels))
+        self.peak = 0.0
+
+    def feed(self, samples: np.ndarray) -> None:
+        samples = np.asarray(samples, dtype=float).reshape(-1, self.channels)
+        count = len(samples)
+        if count == 0:
+            return
+        # True-peak: the samples themselves, and the points between them interpolated by each phase
+        extended = np.concatenate((self.peakHistory, samples))
+        self.peakHistory = extended[len(extended) - len(self.peakHistory):]
+        peak = np.max(np.abs(samples))
+        for kernel in self.peakKernels:
+            for channel in range(self.channels):
+                peak = max(peak, np.max(np.abs(np.convolve(extended[:, channel], kernel, mode="valid"))))
+        self.peak = max(self.peak, float(peak))
+
+        # K-weighting by overlap-add FFT convolution
+        size = 1 << (count + len(self.kernel) - 1 - 1).bit_length()
+        spectrum = np.fft.rfft(samples, size, axis=0) * np.fft.rfft(self.kernel, size)[:, np.newaxis]
+        filtered = np.fft.irfft(spectrum, size, axis=0)[:count + len(self.kernel) - 1]
+        filtered[:len(self.overlap)] += self.overlap
+        self.overlap = filtered[count:].copy()
+        filtered = filtered[:count]
+
+        power = np.concatenate((self.partial, (filtered ** 2) @ self.weights))
+        whole = len(power) // FRAME * FRAME
+        self.frameEnergies.extend(power[:whole].reshape(-1, FRAME).sum(axis=1))
+        self.partial = power[whole:]
+
+    def result(self) -> Dict:
+        """
+        The measurements so far, in the same form as readFrames() returns:
+        times and momentary loudness per 100ms, integrated loudness, duration,
+        highest short-term loudness, loudness range and true-peak.
+        """
+        energies = np.frombuffer(self.frameEnergies) if self.frameEnergies else np.zeros(0)
+        count = len(energies)
+        if count == 0:
+            raise RuntimeError("No EBU R.128 measurements were found.")
+        times = np.arange(count) * 0.1
+
+        # Mean power over each 400ms window, ending with each 100ms frame
+        cumulative = np.concatenate(([0.0], np.cumsum(energies)))
+        window = np.zeros(count)
+        window[3:] = (cumulative[4:] - cumulative[:-4]) / (4 * FRAME)
+        momentary = -0.691 + 10 * np.log10(SILENCE + window)
+        momentary[:3] = -0.691 + 10 * np.log10(SILENCE)
+
+        # Gating blocks are the same 400ms windows
+        blocks = window[3:]
+        blocks = blocks[-0.691 + 10 * np.log10(SILENCE + blocks) >= ABSOLUTE_GATE]
+        loudness = ABSOLUTE_GATE
+        if len(blocks):
+            relative = -0.691 + 10 * np.log10(blocks.mean()) + RELATIVE_GATE
+            gated = blocks[-0.691 + 10 * np.log10(blocks) >= relative]
+            if len(gated):
+                loudness = float(-0.691 + 10 * np.log10(gated.mean()))
+
+        # Short-term loudness over each 3s window, ending with each 100ms frame
+        shortTerm = (cumulative[SHORT_TERM:] - cumulative[:-SHORT_TERM]) / (SHORT_TERM * FRAME)
+        shortTermMax = float(-0.691 + 10 * np.log10(SILENCE + shortTerm.max())) if len(shortTerm) else -120.691
+
+        lra = 0.0
+        shortTerm = shortTerm[-0.691 + 10 * np.log10(SILENCE + shortTerm) >= ABSOLUTE_GATE]
+        if len(shortTerm):
+            relative = -0.691 + 10 * np.log10(shortTerm.mean()) + LRA_GATE
+            gated = np.sort(-0.691 + 10 * np.log10(shortTerm[-0.691 + 10 * np.log10(shortTerm) >= relative]))
+            if len(gated):
+                lra = float(gated[int((len(gated) - 1) * 0.95)] - gated[int((len(gated) - 1) * 0.10)])
+
+        return {"times": times, "momentary": momentary, "loudness": loudness,
+                "duration": float(times[-1]), "dropped": 0,
+                "short_term_max": shortTermMax, "lra": lra, "true_peak": peakToDB(self.peak)}
+
+
+def measurePCM(stream, channels: int, weights: Optional[List[float]] = None, blockSeconds: int = 10) -> Dict:
+    """
+    Measure raw interleaved f32le PCM at 48kHz read from a binary stream,
+    such as FFmpeg's stdout, a few seconds at a time.
+    """
+    meter = LoudnessMeter(channels, weights)
+    blockBytes = blockSeconds * SAMPLE_RATE * channels * 4
+    leftover = b""
+    while True:
+        data = stream.read(blockBytes)
+        if not data:
+            break
+        data = leftover + data
+        usable = len(data) // (channels * 4) * channels * 4
+        leftover = data[usable:]
+        meter.feed(np.frombuffer(data[:usable], dtype="<f4"))
+    return meter.result()
+
+
+# --- Loudness series cache ---
+#
+# The momentary loudness of a track doesn't change when the cue thresholds do, so the
+# series can be kept and reused. Each track's series is stored in its own small .npz file,
+# named after the MD5 hash of its audio (the same hash that's in mezzanine filenames) and the
+# engine that measured it, in subdirectories named after the hash's first two characters:
+#   <cacheDir>/17/17d3cf4a75edd765b5981c5e8322a4dc.ffmpeg.npz
+# Each engine only ever reads its own measurements, so that the two can be compared.
+# Times are kept as float32 (1ms resolution even for multi-hour files) and momentary
+# loudness as float16 (better than 0.07 LU), which is plenty for finding cue points.
+# Entries made before the loudness range and true-peak were measured are treated as missing.
+
+def _seriesPath(cacheDir: str, key: str, engine: str) -> str:
+    key = key.lower()
+    return os.path.join(cacheDir, key[:2], key + "." + engine + ".npz")
+
+
+def loadSeries(cacheDir: str, key: str, engine: str = "ffmpeg") -> Optional[Dict]:
+    """
+    Return the series cached for the audio hash 'key', as measured by 'engine',
+    in the same form as readFrames() returns, or None if it isn't in the cache.
+    """
+    if not cacheDir or not key:
+        return None
+    try:
+        with np.load(_seriesPath(cacheDir, key, engine)) as cached:
+            return {"times": cached["times"].astype(float),
+                    "momentary": cached["momentary"].astype(float),
+                    "loudness": float(cached["loudness"]),
+                    "duration": float(cached["duration"]),
+                    "dropped": 0,
+                    "short_term_max": float(cached["short_term_max"]),
+                    "lra": float(cached["lra"]),
+                    "true_peak": float(cached["true_peak"])}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def saveSeries(cacheDir: str, key: str, series: Dict, engine: str = "ffmpeg") -> None:
+    """
+    Store a series measured by 'engine' in the cache under the audio hash 'key'.
+    The file is written under a temporary name and renamed into place, so
+    concurrent workers and interrupted runs never leave a partial entry.
+    """
+    if not cacheDir or not key:
+        return
+    path = _seriesPath(cacheDir, key, engine)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporaryFile = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, times=np.asarray(series["times"], dtype=np.float32),
+                     momentary=np.asarray(series["momentary"], dtype=np.float16),
+                     loudness=series["loudness"], duration=series["duration"],
+                     short_term_max=series["short_term_max"], lra=series["lra"], true_peak=series["true_peak"])
+        os.replace(temporaryFile, path)
+    except BaseException:
+        os.remove(temporaryFile)
+        raise
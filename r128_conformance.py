@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+# Checks the NumPy loudness meter in r128.py.
+# First against the expected results of the EBU Tech 3341 and Tech 3342 test signals, generated here,
+# then against FFmpeg's own ebur128 filter, on signals generated by FFmpeg's lavfi sources.
+# Exits with status 1 if any check fails.
+
+import argparse, os, subprocess, sys, tempfile
+import numpy as np
+import r128
+
+FFMPEG = "/usr/local/bin/ffmpeg"
+FFPROBE = "/usr/local/bin/ffprobe"
+
+SR = r128.SAMPLE_RATE
+
+def sine(dbfs, seconds, channels=2, freq=997.0):
+    t = np.arange(int(SR * seconds)) / SR
+    return np.repeat((10 ** (dbfs / 20) * np.sin(2 * np.pi * freq * t))[:, np.newaxis], channels, axis=1)
+
+# EBU Tech 3341 (2016) cases 1 to 4: stereo 997Hz sines, and the expected integrated loudness
+TECH3341 = [
+    ("3341 case 1", lambda: sine(-23, 20), -23.0),
+    ("3341 case 2", lambda: sine(-33, 20), -33.0),
+    ("3341 case 3", lambda: np.concatenate([sine(-36, 10), sine(-23, 60), sine(-36, 10)]), -23.0),
+    ("3341 case 4", lambda: np.concatenate([sine(-72, 10), sine(-36, 10), sine(-23, 60), sine(-36, 10), sine(-72, 10)]), -23.0),
+]
+
+# EBU Tech 3342 (2016) cases 1 to 4: stereo 1kHz sines, and the expected loudness range
+TECH3342 = [
+    ("3342 case 1", lambda: np.concatenate([sine(-20, 20, freq=1000), sine(-30, 20, freq=1000)]), 10.0),
+    ("3342 case 2", lambda: np.concatenate([sine(-20, 20, freq=1000), sine(-15, 20, freq=1000)]), 5.0),
+    ("3342 case 3", lambda: np.concatenate([sine(-40, 20, freq=1000), sine(-20, 20, freq=1000)]), 20.0),
+    ("3342 case 4", lambda: np.concatenate([sine(-50, 20, freq=1000), sine(-35, 20, freq=1000), sine(-20, 20, freq=1000),
+                                            sine(-35, 20, freq=1000), sine(-50, 20, freq=1000)]), 15.0),
+]
+
+# Signals for comparing with FFmpeg: name and lavfi source
+A23 = "0.0707946"     # -23 dBFS
+LAVFI = [
+    ("stereo sine", "aevalsrc=%s*sin(2*PI*997*t)|%s*sin(2*PI*997*t):s=48000:d=20" % (A23, A23)),
+    ("level steps", "aevalsrc=if(lt(t\\,10)\\,0.0158\\,if(lt(t\\,40)\\,0.0708\\,0.0158))*sin(2*PI*997*t):c=stereo:s=48000:d=50"),
+    ("pink noise, mono", "anoisesrc=color=pink:seed=42:amplitude=0.1:sample_rate=48000:d=30"),
+    ("silent lead-in and fade", "aevalsrc=if(lt(t\\,3)\\,0\\,0.3*(1-(t-3)/27))*sin(2*PI*440*t):c=stereo:s=48000:d=30"),
+    ("5.1 noise", "anoisesrc=color=white:seed=7:amplitude=0.05:sample_rate=48000:d=20,aformat=channel_layouts=mono,"
+                  "pan=5.1|FL=c0|FR=0.5*c0|FC=0.7*c0|LFE=c0|BL=0.3*c0|BR=0.3*c0"),
+    ("44.1kHz sine", "aevalsrc=%s*sin(2*PI*1000*t)|%s*sin(2*PI*1000*t):s=44100:d=20" % (A23, A23)),
+]
+
+def check(name, ok, detail):
+    print("%s  %-28s %s" % ("PASS" if ok else "FAIL", name, detail))
+    return ok
+
+def ffmpegSeries(filename):
+    with subprocess.Popen([FFMPEG, "-hide_banner", "-v", "quiet", "-i", filename, "-af", \
+            "ebur128=metadata=1:peak=true,ametadata=mode=print:file=-", "-f", "null", "null"], \
+            stdout=subprocess.PIPE, encoding='utf-8') as proc:
+        return(r128.readFrames(proc.stdout))
+
+def numpySeries(filename, channels, layout):
+    with subprocess.Popen([FFMPEG, "-hide_banner", "-v", "quiet", "-i", filename, "-map", "0:a:0", \
+            "-ar", str(SR), "-f", "f32le", "-"], stdout=subprocess.PIPE) as proc:
+        return(r128.measurePCM(proc.stdout, channels, r128.channelWeights(channels, layout)))
+
+parser = argparse.ArgumentParser(description="Check the NumPy EBU R.128 meter against reference signals and FFmpeg.")
+parser.add_argument("-t", "--tolerance", help="Largest difference allowed, in LU. Default: %(default)s", default=0.1, type=float)
+parser.add_argument("--peak-tolerance", help="Largest true-peak difference allowed from FFmpeg, in dB. Default: %(default)s",
+                    default=0.5, type=float)
+parser.add_argument("--no-ffmpeg", help="Only run the checks that don't need FFmpeg", action="store_true")
+args = parser.parse_args()
+
+passed = True
+
+for name, signal, expected in TECH3341:
+    meter = r128.LoudnessMeter(2)
+    meter.feed(signal())
+    series = meter.result()
+    passed &= check(name, abs(series["loudness"] - expected) <= args.tolerance,
+                    "I = %.2f, expected %.1f" % (series["loudness"], expected))
+
+for name, signal, expected in TECH3342:
+    meter = r128.LoudnessMeter(2)
+    meter.feed(signal())
+    series = meter.result()
+    passed &= check(name, abs(series["lra"] - expected) <= args.tolerance,
+                    "LRA = %.2f, expected %.1f" % (series["lra"], expected))
+
+if not args.no_ffmpeg:
+    with tempfile.TemporaryDirectory() as tmp:
+        for index, (name, source) in enumerate(LAVFI):
+            filename = os.path.join(tmp, "signal%d.wav" % index)
+            subprocess.check_call([FFMPEG, "-hide_banner", "-v", "quiet", "-y", "-f", "lavfi", "-i", source, \
+                    "-c:a", "pcm_f32le", filename])
+            probe = subprocess.check_output([FFPROBE, "-v", "quiet", "-select_streams", "a:0", \
+                    "-show_entries", "stream=channels,channel_layout", "-of", "default=noprint_wrappers=1", filename], \
+                    encoding='utf-8').splitlines()
+            fields = dict(line.split("=", 1) for line in probe if "=" in line)
+
+            reference = ffmpegSeries(filename)
+            measured = numpySeries(filename, int(fields["channels"]), fields.get("channel_layout"))
+
+            # Compare momentary loudness frame by frame, wherever FFmpeg hears anything
+            frames = min(len(reference["momentary"]), len(measured["momentary"]))
+            audible = reference["momentary"][:frames] > -70
+            worst = float(np.max(np.abs(reference["momentary"][:frames][audible] - measured["momentary"][:frames][audible]))) \
+                    if audible.any() else 0.0
+            integrated = abs(reference["loudness"] - measured["loudness"])
+            passed &= check(name, worst <= args.tolerance and integrated <= args.tolerance and \
+                            abs(len(reference["momentary"]) - len(measured["momentary"])) <= 1,
+                            "I = %.2f (FFmpeg %.2f), worst M difference %.3f LU, %s/%s frames" % \
+                            (measured["loudness"], reference["loudness"], worst, len(measured["momentary"]), len(reference["momentary"])))
+            passed &= check(name + ", range, peak", abs(reference["lra"] - measured["lra"]) <= args.tolerance and \
+                            abs(reference["short_term_max"] - measured["short_term_max"]) <= args.tolerance and \
+                            abs(reference["true_peak"] - measured["true_peak"]) <= args.peak_tolerance,
+                            "LRA = %.2f (FFmpeg %.2f), max S = %.2f (FFmpeg %.2f), TP = %.2f (FFmpeg %.2f)" % \
+                            (measured["lra"], reference["lra"], measured["short_term_max"], reference["short_term_max"],
+                             measured["true_peak"], reference["true_peak"]))
+
+sys.exit(0 if passed else 1)
@@ -0,0 +1,243 @@
+#!/usr/bin/python3
+# Watches drop folders for new music, and makes each new file on-air ready as soon as it has
+# finished arriving: remuxed into the mezzanine directory, hashed, loudness-measured and
+# annotated in the processed playlist, then fingerprinted into the fingerprint database.
+# This is the same work as cue_playlist.py followed by chromaprint_db.py, done one file at a time
+# by a long-running process instead of over the whole library at once.
+# New files are noticed by inotify on Linux, or by listing the folders every few seconds elsewhere.
+
+import argparse, concurrent.futures, csv, ctypes, ctypes.util, os, select, signal, struct, subprocess, sys, threading, time
+import cue_playlist
+import chromaprint_db
+import ingest
+import fingerprints
+
+# inotify events of interest, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+EVENT = struct.Struct("iIII")
+
+# Files that are still being written by something else, or aren't audio
+IGNORED_SUFFIXES = (".part", ".tmp", ".crdownload", ".m3u", ".m3u8", ".csv", ".txt", ".jpg", ".png", ".nfo")
+
+def log(message):
+    print("%s %s" % (time.strftime("%Y-%m-%d %H:%M:%S"), message), flush=True)
+
+class InotifyWatcher(object):
+    # Reports the paths of files created, written or moved into the watched folders and any
+    # folders made inside them.
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.addWatch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+
+    def watch(self, folder):
+        # Returns the files already in the folder, and those in any folders inside it
+        found = []
+        for root, dirs, files in os.walk(folder):
+            descriptor = self.addWatch(self.fd, os.fsencode(root), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+            if descriptor < 0:
+                log("Can't watch %s: %s" % (root, os.strerror(ctypes.get_errno())))
+                continue
+            self.folders[descriptor] = root
+            found += [os.path.join(root, name) for name in files]
+        return(found)
+
+    def changes(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return([])
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return([])
+        paths = []
+        offset = 0
+        while offset < len(data):
+            descriptor, mask, cookie, length = EVENT.unpack_from(data, offset)
+            name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b"\0")
+            offset += EVENT.size + length
+            folder = self.folders.get(descriptor)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    paths += self.watch(path)
+            else:
+                paths.append(path)
+        return(paths)
+
+class PollingWatcher(object):
+    # The same, for systems without inotify: every file in the folders is reported each time,
+    # and those already dealt with are ignored by the caller.
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.roots = []
+
+    def watch(self, folder):
+        self.roots.append(folder)
+        return(self.listing())
+
+    def listing(self):
+        return([os.path.join(root, name) for folder in self.roots for root, dirs, files in os.walk(folder) for name in files])
+
+    def changes(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        return(self.listing())
+
+def fileState(path):
+    try:
+        info = os.stat(path)
+    except OSError:
+        return(None)
+    return((info.st_size, info.st_mtime_ns))
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch drop folders, and make new music on-air ready as it arrives.",
+            epilog="For support, contact john@johnwarburton.net")
+    parser.add_argument("folders", help="Drop folders to watch, with any folders inside them", nargs="+")
+    parser.add_argument("-m", "--mezzanine", help="Directory for mezzanine-format files", required=True, type=str)
+    parser.add_argument("-o", "--output", help="Processed playlist, appended to. Default: %(default)s", default="processed.m3u8", type=str)
+    parser.add_argument("-f", "--fingerprints", help="Fingerprint database, appended to. Default: %(default)s", default="chromaprints.csv", type=str)
+    parser.add_argument("--store", help="Binary fingerprint store to append to, instead of the fingerprint database", type=str)
+    parser.add_argument("--failures", help="CSV file listing the files that couldn't be fingerprinted, and why "
+                        "(default: '-failures.csv' suffix on the fingerprint database)", type=str)
+    parser.add_argument("-d", "--duration", help="Duration, in seconds, of audio in fingerprint. Default: %(default)s", default=30, type=int)
+    parser.add_argument("-l", "--level",  help="LU below average loudness to trigger next track. Default: %(default)s", default=8.0, type=float)
+    parser.add_argument("-c", "--cue", help="LU below average loudness for track cue-in point. Default: %(default)s", default=40.0, type=float)
+    parser.add_argument("--true-peak-ceiling", help="Highest true-peak, in dBTP, that a track may reach once amplified "
+                        "by liq_amplify. The gain of louder tracks is reduced. Default: no limit", type=float)
+    parser.add_argument("-j", "--jobs", help="Number of files to process at once. Default: %(default)s", default=2, type=int)
+    parser.add_argument("-s", "--settle", help="Seconds a file must stay the same size before it is taken as fully copied. "
+                        "Default: %(default)s", default=10.0, type=float)
+    parser.add_argument("--poll", help="Seconds between listings of the folders, where inotify isn't available. Default: %(default)s",
+                        default=5.0, type=float)
+    parser.add_argument("--rescan", help="Seconds between listings of the mezzanine directory, to see files other tools "
+                        "have added or removed. Default: %(default)s", default=300.0, type=float)
+    parser.add_argument("--hash-cache", help="File caching the content hash of each source file, so that files already "
+                        "ingested are recognised quickly on restart. Default: '.hash-cache.jsonl' in the mezzanine directory", type=str)
+    args = parser.parse_args()
+
+    mezzanine = os.path.abspath(args.mezzanine)
+    os.makedirs(mezzanine, exist_ok=True)
+    hashCache = args.hash_cache or os.path.join(mezzanine, ".hash-cache.jsonl")
+    failuresFile = args.failures or os.path.splitext(args.store.rstrip(os.sep) if args.store else args.fingerprints)[0] + "-failures.csv"
+
+    try:
+        watcher = InotifyWatcher()
+        log("Watching with inotify.")
+    except (AttributeError, OSError):
+        watcher = PollingWatcher(args.poll)
+        log("inotify isn't available. Listing the folders every %s seconds." % args.poll)
+
+    # Files waiting to settle: path -> (size and mtime when last seen, when that was first seen)
+    pending = {}
+    # Files handed to a worker, or finished with, and their size and mtime then
+    seen = {}
+    lock = threading.Lock()
+    store = fingerprints.FingerprintStore(args.store) if args.store else None
+
+    def process(path):
+        # Runs in a worker. analyse() returns None for audio already in the mezzanine directory.
+        result = cue_playlist.analyse(path, args.level, args.cue, mezzanine=mezzanine, singlePass=True, hashCacheFile=hashCache)
+        if result is None:
+            log("Already ingested: %s" % path)
+            return
+        # The mezzanine file exists now, so it goes on the playlist straight away, whatever
+        # becomes of its fingerprint.
+        with lock:
+            with open(args.output, "a", encoding="utf-8") as out:
+                if out.tell() == 0:
+                    out.write("#EXTM3U\n")
+                out.write(cue_playlist.playlistLine(result, result["mezzanine_name"] + "\n", ceiling=args.true_peak_ceiling))
+                out.flush()
+                os.fsync(out.fileno())
+        # A file fpcalc can't read is listed in the failures file, as chromaprint_db.py does, and
+        # left out of the database so that chromaprint_db.py tries it again.
+        try:
+            if store is not None:
+                words, dur = chromaprint_db.fingerprintWords(result["mezzanine_name"], args.duration)
+            else:
+                row = chromaprint_db.fingerprintRow(result["mezzanine_name"], args.duration)
+        except (subprocess.CalledProcessError, OSError, IndexError, ValueError) as error:
+            log("Ingested, but couldn't fingerprint: %s as %s: %s" % (path, result["mezzanine_name"], error))
+            with lock:
+                with open(failuresFile, "a", newline="", encoding="utf-8") as failed:
+                    csv.writer(failed).writerow([result["mezzanine_name"], str(error)])
+            return
+        with lock:
+            if store is not None:
+                store.append(result["mezzanine_name"], words, dur)
+            else:
+                with open(args.fingerprints, "a", newline="", encoding="utf-8") as fd:
+                    csv.writer(fd).writerow(row)
+                    fd.flush()
+                    os.fsync(fd.fileno())
+        log("Ingested: %s as %s" % (path, result["mezzanine_name"]))
+
+    def finished(future, path):
+        try:
+            future.result()
+        except Exception as error:
+            # Leave it alone until it changes: a broken file isn't retried for ever
+            log("Failed: %s: %s" % (path, error))
+
+    def noticed(paths):
+        now = time.monotonic()
+        for path in paths:
+            if os.path.basename(path).startswith(".") or path.lower().endswith(IGNORED_SUFFIXES):
+                continue
+            if os.path.abspath(path).startswith(mezzanine + os.sep):
+                continue
+            state = fileState(path)
+            if state is None or seen.get(path) == state:
+                continue
+            if path not in pending or pending[path][0] != state:
+                pending[path] = (state, now)
+
+    # Stop taking new files on SIGTERM, as on Ctrl-C, but let those under way finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        try:
+            for folder in args.folders:
+                log("Watching %s" % folder)
+                noticed(watcher.watch(os.path.abspath(folder)))
+            rescanned = time.monotonic()
+            while True:
+                noticed(watcher.changes(1.0))
+                now = time.monotonic()
+                # The index of the mezzanine directory is kept in memory, so it is brought up to date
+                # from time to time. Files weeded from the directory can then be ingested again.
+                if now - rescanned >= args.rescan:
+                    ingest.mezzanineIndex(mezzanine).rescan()
+                    rescanned = now
+                for path, (state, since) in list(pending.items()):
+                    # A file still growing, or touched within the settling time, is still being copied
+                    current = fileState(path)
+                    if current is None:
+                        del pending[path]
+                    elif current != state:
+                        pending[path] = (current, now)
+                    elif now - since >= args.settle:
+                        del pending[path]
+                        seen[path] = state
+                        future = executor.submit(process, path)
+                        future.add_done_callback(lambda future, path=path: finished(future, path))
+        except (KeyboardInterrupt, SystemExit):
+            log("Stopping once the files under way are done.")
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+if __name__ == "__main__":
+    main()